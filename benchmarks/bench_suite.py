@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""Benchmark playlist parsing and copying of Squarepig.
+
+Generates synthetic m3u and XSPF playlists and source trees of tiny and huge
+files, on tmpfs and on local disk, then times Playlist parsing and
+SquarePig.copy_to end to end. Every case runs in a fresh interpreter, so
+peak memory and syscall counts aren't skewed by earlier cases. Results are
+written as JSON; given the results of an earlier run as baseline, the suite
+fails if any case got slower, hungrier or chattier than the threshold allows.
+
+Run from the top of a checkout with `make bench`, passing options in
+BENCHFLAGS, or as `PYTHONPATH=. python benchmarks/bench_suite.py`.
+"""
+
+import argparse
+import json
+import resource
+import shutil
+import subprocess
+import sys
+from os import makedirs, path
+from tempfile import mkdtemp
+
+from bench_xspf import write_xspf
+from benchutils import measure
+
+from squarepig.backpig import Playlist, SquarePig
+
+
+TMPFS = '/dev/shm'
+
+# metrics compared against the baseline; larger values are worse for each
+REGRESSION_METRICS = ['seconds', 'peak_bytes', 'syscalls']
+
+
+def write_m3u(filename, tracks):
+    """Write synthetic m3u playlist with given number of tracks."""
+    with open(filename, 'w', encoding='utf-8') as ofile:
+        ofile.write('#EXTM3U\n')
+        for i in range(tracks):
+            ofile.write('/music/Artist {0}/Album {1}/{2:05d} Tïtle.flac\n'
+                        .format(i % 300, i % 1000, i))
+
+
+def write_tree(directory, count, size):
+    """Write count files of size bytes and an m3u playlist listing them."""
+    makedirs(directory)
+    block = bytes(range(256)) * 4096
+    playlist = path.join(directory, 'tree.m3u')
+    with open(playlist, 'w', encoding='utf-8') as m3u:
+        for i in range(count):
+            filename = path.join(directory, '{0:06d}.ogg'.format(i))
+            with open(filename, 'wb') as ofile:
+                remaining = size
+                while remaining:
+                    remaining -= ofile.write(block[:remaining])
+            m3u.write(filename + '\n')
+    return playlist
+
+
+def parse_case(case):
+    """Count files in a playlist."""
+    playlist = Playlist(case['playlist'])
+
+    def parse():
+        return sum(1 for _ in playlist.iter_files())
+
+    count, elapsed, syscalls, peak = measure(parse)
+    return {
+        'entries': count,
+        'seconds': elapsed,
+        'entries_per_second': count / elapsed if elapsed else None,
+        'peak_bytes': peak,
+        'syscalls': syscalls,
+    }
+
+
+def copy_case(case):
+    """Copy the files of a playlist."""
+    sargasso = SquarePig()
+    playlist = Playlist(case['playlist'])
+
+    def copy():
+        sargasso.copy_to(playlist.iter_files(), case['destination'],
+                         jobs=case['jobs'])
+        return sargasso.get_stats()['copied_bytes']
+
+    copied, elapsed, syscalls, _ = measure(copy, memory=False)
+    return {
+        'files': sargasso.get_progress()[1],
+        'failed': len(sargasso.get_failed()),
+        'bytes': copied,
+        'seconds': elapsed,
+        'bytes_per_second': copied / elapsed if elapsed else None,
+        # ru_maxrss is in KiB on Linux
+        'peak_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        * 1024,
+        'syscalls': syscalls,
+    }
+
+
+CASES = {'parse': parse_case, 'copy': copy_case}
+
+
+def run_case(case, repeat=1):
+    """Run case in fresh interpreters, returning results of the fastest run.
+
+    The destination of copy cases is removed after each run.
+    """
+    runs = []
+    for run in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, path.abspath(__file__), '--case',
+             json.dumps(case)])
+        runs.append(json.loads(output.decode()))
+        if case['kind'] == 'copy':
+            shutil.rmtree(case['destination'])
+    return min(runs, key=lambda result: result['seconds'])
+
+
+def regressions(results, baseline, threshold):
+    """Return descriptions of metrics which got worse than threshold."""
+    found = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric in REGRESSION_METRICS:
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            if new > old * (1 + threshold):
+                found.append("{0}: {1} {2:.4g} -> {3:.4g} (+{4:.0%})".format(
+                    name, metric, old, new, new / old - 1))
+    return found
+
+
+def locations(args):
+    """Return directories to create source trees in, by name."""
+    found = {'disk': args.disk_dir}
+    if path.isdir(TMPFS):
+        found['tmpfs'] = TMPFS
+    return found
+
+
+def main():
+    """Run benchmark suite."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--sizes', default='1000,100000,1000000',
+        help='comma-separated numbers of playlist entries '
+             '(default: 1000,100000,1000000)')
+    parser.add_argument(
+        '--tiny', metavar='COUNT', type=int, default=2000,
+        help='number of 4 KiB files in the tiny tree (default: 2000)')
+    parser.add_argument(
+        '--huge', metavar='MIB', type=int, default=256,
+        help='size of each of the two files in the huge tree (default: 256)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=4,
+        help='number of concurrent copies (default: 4)')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='runs per case, of which the fastest is kept (default: 3)')
+    parser.add_argument(
+        '--disk-dir', default=None,
+        help='directory on local disk for source trees (default: system '
+             'temporary directory)')
+    parser.add_argument(
+        '-o', '--output', help='write results as JSON to OUTPUT')
+    parser.add_argument(
+        '--baseline', help='compare results to JSON of an earlier run')
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='relative increase of a metric counted as regression '
+             '(default: 0.2)')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        case = json.loads(args.case)
+        print(json.dumps(CASES[case['kind']](case)))
+        return
+
+    results = {}
+    workdir = mkdtemp(prefix='squarepig-bench-')
+    try:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            for extension, write in [('m3u', write_m3u), ('xspf', write_xspf)]:
+                filename = path.join(workdir, '{0}.{1}'.format(size,
+                                                              extension))
+                write(filename, size)
+                name = 'parse/{0}/{1}'.format(extension, size)
+                results[name] = run_case({'kind': 'parse',
+                                          'playlist': filename}, args.repeat)
+                print(name, json.dumps(results[name]), flush=True)
+
+        for location, directory in sorted(locations(args).items()):
+            treedir = mkdtemp(prefix='squarepig-bench-', dir=directory)
+            try:
+                for tree, count, size in [
+                        ('tiny', args.tiny, 4096),
+                        ('huge', 2, args.huge << 20)]:
+                    source = path.join(treedir, tree)
+                    playlist = write_tree(source, count, size)
+                    name = 'copy/{0}/{1}'.format(location, tree)
+                    results[name] = run_case({
+                        'kind': 'copy', 'playlist': playlist,
+                        'destination': path.join(treedir, tree + '-copy'),
+                        'jobs': args.jobs}, args.repeat)
+                    print(name, json.dumps(results[name]), flush=True)
+                    shutil.rmtree(source)
+            finally:
+                shutil.rmtree(treedir)
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'w') as ofile:
+            json.dump(results, ofile, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as ofile:
+            found = regressions(results, json.load(ofile), args.threshold)
+        for regression in found:
+            print("regression:", regression, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
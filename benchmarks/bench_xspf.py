@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""Compare the XSPF parsers of Squarepig on a large playlist.
+
+Run from the top of a checkout with `make bench-xspf`, or as
+`PYTHONPATH=. python benchmarks/bench_xspf.py`.
+"""
+
+import argparse
+from os import path
+from tempfile import TemporaryDirectory
+from urllib.parse import quote
+
+from benchutils import measure
+
+from squarepig.backpig import Playlist
+
+
+def write_xspf(filename, tracks):
+    """Write synthetic XSPF playlist with given number of tracks."""
+    with open(filename, 'w', encoding='utf-8') as ofile:
+        ofile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        ofile.write('<playlist version="1" xmlns="http://xspf.org/ns/0/">\n')
+        ofile.write('<trackList>\n')
+        for i in range(tracks):
+            location = quote('/music/Artist {0}/Album {1}/{2:05d} Tïtle.flac'
+                             .format(i % 300, i % 1000, i))
+            ofile.write(
+                '<track><location>file://{0}</location>'
+                '<title>Title {1}</title></track>\n'.format(location, i))
+        ofile.write('</trackList>\n</playlist>\n')
+
+
+def main():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--tracks', type=int, default=100000,
+                        help='number of tracks in playlist (default: 100000)')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmpdir:
+        filename = path.join(tmpdir, 'bench.xspf')
+        write_xspf(filename, args.tracks)
+        playlist = Playlist(filename)
+
+        def parse_etree():
+            return sum(1 for _ in playlist.iter_files())
+
+        def parse_soup():
+            with open(filename, 'rb') as ofile:
+                return sum(1 for _ in playlist._parse_xspf_soup(ofile, None))
+
+        for name, function in [('iterparse', parse_etree),
+                               ('beautifulsoup', parse_soup)]:
+            try:
+                count, elapsed, syscalls, peak = measure(function)
+            except Playlist.UnsupportedPlaylistFormat:
+                print("{0:>14}: skipped, bs4 is not installed".format(name))
+                continue
+            print("{0:>14}: {1} tracks in {2:.2f}s, {3:.1f} MiB peak".format(
+                name, count, elapsed, peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
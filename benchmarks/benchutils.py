@@ -0,0 +1,35 @@
+"""Measurements shared by the benchmarks of Squarepig."""
+
+import tracemalloc
+from time import perf_counter
+
+
+def io_counters():
+    """Return read and write syscalls of this process so far, if known."""
+    try:
+        with open('/proc/self/io') as ofile:
+            counters = dict(line.split(': ') for line in ofile)
+    except OSError:
+        return None
+    return int(counters['syscr']) + int(counters['syscw'])
+
+
+def measure(function, memory=True):
+    """Return result, runtime, read/write syscalls and peak memory of function.
+
+    Peak memory is None unless memory is set, which runs function twice.
+    """
+    syscalls = io_counters()
+    start = perf_counter()
+    result = function()
+    elapsed = perf_counter() - start
+    if syscalls is not None:
+        syscalls = io_counters() - syscalls
+    peak = None
+    if memory:
+        # tracing slows things down considerably, so measure memory separately
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, syscalls, peak
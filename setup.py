@@ -36,6 +36,7 @@ setup(
         keywords='playlist audio',
 
     packages=['squarepig'],
+    python_requires='>=3.9',
     install_requires=[],
 
     entry_points={
@@ -48,7 +49,9 @@ setup(
         'License :: OSI Approved :: GPLv3 License',
 
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
 )
@@ -0,0 +1,68 @@
+"""Asyncio interface for Squarepig."""
+
+import asyncio
+from threading import Thread
+
+from squarepig.backpig import SquarePig
+
+
+async def copy_to_async(files, destination, jobs=1, semaphore=None,
+                        sargasso=None, **options):
+    """Copy files to destination, yielding progress events.
+
+    Asynchronous generator of the (event, data) pairs a SquarePig passes to
+    its listeners, see SquarePig.add_listener. The copy job itself runs in a
+    thread of its own with up to `jobs` concurrent copies; options are passed
+    on to SquarePig.copy_to, e.g. a concurrent.futures executor shared by
+    several jobs.
+
+    If given, the asyncio.Semaphore `semaphore` is held while the job runs,
+    which limits how many of the jobs sharing it run at once. Cancelling the
+    task iterating over the events - or closing the generator - stops the
+    job: copies which are already running are allowed to finish first. A
+    SquarePig.CopyError of the job is raised by the generator.
+
+    Pass in `sargasso` to get at the results of the job afterwards.
+    """
+    if sargasso is None:
+        sargasso = SquarePig()
+    loop = asyncio.get_running_loop()
+    # events and the end of the job arrive through the event loop in the
+    # order they happened; the job ends with a (None, exception) pair
+    events = asyncio.Queue()
+
+    def listener(event, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    def run():
+        error = None
+        try:
+            sargasso.copy_to(files, destination, jobs=jobs, **options)
+        except Exception as e:
+            error = e
+        loop.call_soon_threadsafe(events.put_nowait, (None, error))
+
+    if semaphore is not None:
+        await semaphore.acquire()
+    finished = False
+    sargasso.add_listener(listener)
+    try:
+        Thread(target=run, daemon=True).start()
+        while True:
+            event, data = await events.get()
+            if event is None:
+                finished = True
+                if data is not None:
+                    raise data
+                return
+            yield event, data
+    finally:
+        if not finished:
+            sargasso.request_stop()
+            while (await events.get())[0] is not None:
+                pass
+            # the job might have ended before seeing the request
+            sargasso.stop = False
+        sargasso.remove_listener(listener)
+        if semaphore is not None:
+            semaphore.release()
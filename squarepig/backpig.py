@@ -1,9 +1,223 @@
 """Backend for Squarepig."""
 
-from os import path, makedirs
-from re import match, sub
-from shutil import copy
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import (
+    Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, InvalidStateError)
+from functools import partial
+from itertools import chain, islice
+from os import (
+    path, access, makedirs, listdir, lstat, remove, rename, stat, utime, R_OK)
+from re import compile, match
+from shutil import disk_usage
+from stat import S_ISREG
+from struct import Struct
 from sys import stderr
+from threading import Lock
+from time import monotonic
+
+from squarepig.checksums import (
+    MANIFESTS, find_manifest, hash_file, new_hash, read_manifest,
+    remove_manifest, write_manifest)
+from squarepig.copyfile import (
+    clone_file, export_file, Unsupported, LINK_MODES)
+from squarepig.durable import Committer, is_temp_name, temp_name
+from squarepig.journal import Journal
+from squarepig.transcode import Transcoder
+from squarepig.writers import Writer, open_writer
+
+
+# FAT file systems, which most USB sticks use, only store modification times
+# with a resolution of two seconds
+MTIME_WINDOW = 2
+
+# threads and files per thread used for stat'ing all files of a playlist
+PLAN_JOBS = 32
+PLAN_BATCH = 256
+
+# files smaller than this are copied in batches of up to SMALL_BATCH files by
+# a single task, saving the overhead of scheduling each of them on its own
+SMALL_FILE = 1 << 20
+SMALL_BATCH = 16
+
+URI_SCHEME = compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
+
+
+def resolve(future, result):
+    """Set result of future unless that has happened already."""
+    try:
+        future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class PathList(Sequence):
+
+    """Compact, read-only sequence of file paths.
+
+    Each path is kept as an index into a table of directories plus its
+    basename, so the directories shared by the entries of large playlists
+    are stored only once. Basenames are packed into strings of CHUNK names
+    each, which saves the overhead of a string object per entry. Paths are
+    put together again on access.
+    """
+
+    CHUNK = 1024
+
+    # header of the binary format of dump and load: magic, number of
+    # entries and lengths of the directory and name tables
+    MAGIC = b'SQPL\0\0\0\1'
+    HEADER = Struct('<8sQQQ')
+
+    def __init__(self, files=()):
+        """Initialisation."""
+        self._directories = []
+        self._directory_index = {}
+        self._parents = array('I')
+        # packed names, where each name starts and names not packed yet
+        self._chunks = []
+        self._offsets = array('I')
+        self._pending = []
+        for file in files:
+            self.append(file)
+
+    def append(self, file):
+        """Add file at the end."""
+        # the directory keeps its trailing slash, so '/x' and 'x' differ
+        split = file.rfind('/') + 1
+        directory = file[:split]
+        index = self._directory_index.get(directory)
+        if index is None:
+            index = len(self._directories)
+            self._directory_index[directory] = index
+            self._directories.append(directory)
+        self._parents.append(index)
+        self._pending.append(file[split:])
+        if len(self._pending) == self.CHUNK:
+            self._pack()
+
+    def _pack(self):
+        offset = 0
+        for name in self._pending:
+            self._offsets.append(offset)
+            offset += len(name)
+        self._chunks.append(''.join(self._pending))
+        self._pending = []
+
+    def _name(self, index):
+        chunk, position = divmod(index, self.CHUNK)
+        if chunk == len(self._chunks):
+            return self._pending[position]
+        names = self._chunks[chunk]
+        end = (self._offsets[index + 1] if position + 1 < self.CHUNK
+               else len(names))
+        return names[self._offsets[index]:end]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("PathList index out of range")
+        return self._directories[self._parents[index]] + self._name(index)
+
+    def __len__(self):
+        return len(self._parents)
+
+    def _names(self):
+        offsets = self._offsets
+        for chunk, names in enumerate(self._chunks):
+            first = chunk * self.CHUNK
+            for index in range(first, first + self.CHUNK):
+                end = (offsets[index + 1] if index + 1 < first + self.CHUNK
+                       else len(names))
+                yield names[offsets[index]:end]
+        for name in self._pending:
+            yield name
+
+    def __iter__(self):
+        directories = self._directories
+        for parent, name in zip(self._parents, self._names()):
+            yield directories[parent] + name
+
+    def dump(self, ofile):
+        """Write paths to binary file object."""
+        # NUL can't be part of a path, so it's safe as separator
+        directories = '\0'.join(self._directories).encode(
+            'utf-8', 'surrogateescape')
+        names = '\0'.join(self._chunks + ([''.join(self._pending)]
+                                          if self._pending else []))
+        names = names.encode('utf-8', 'surrogateescape')
+        offsets = array('I', self._offsets)
+        offset = 0
+        for name in self._pending:
+            offsets.append(offset)
+            offset += len(name)
+        ofile.write(self.HEADER.pack(self.MAGIC, len(self), len(directories),
+                                     len(names)))
+        ofile.write(directories)
+        ofile.write(names)
+        ofile.write(self._parents.tobytes())
+        ofile.write(offsets.tobytes())
+
+    @classmethod
+    def load(cls, ifile):
+        """Read paths written by dump from binary file object.
+
+        Raises ValueError if the data isn't in the format dump writes.
+        """
+        header = ifile.read(cls.HEADER.size)
+        if len(header) != cls.HEADER.size:
+            raise ValueError("truncated header")
+        magic, length, directories_size, names_size = cls.HEADER.unpack(
+            header)
+        if magic != cls.MAGIC:
+            raise ValueError("unknown format")
+        paths = cls()
+        directories = ifile.read(directories_size)
+        names = ifile.read(names_size)
+        parents = ifile.read(length * paths._parents.itemsize)
+        offsets = ifile.read(length * paths._offsets.itemsize)
+        if (len(directories) != directories_size or
+                len(names) != names_size or
+                len(parents) != length * paths._parents.itemsize or
+                len(offsets) != length * paths._offsets.itemsize):
+            raise ValueError("truncated data")
+        if not length:
+            return paths
+        paths._directories = directories.decode(
+            'utf-8', 'surrogateescape').split('\0')
+        paths._directory_index = {
+            directory: index
+            for index, directory in enumerate(paths._directories)}
+        paths._parents.frombytes(parents)
+        paths._offsets.frombytes(offsets)
+        chunks = names.decode('utf-8', 'surrogateescape').split('\0')
+        packed = length - length % cls.CHUNK
+        if (len(chunks) != -(-length // cls.CHUNK) or
+                max(paths._parents) >= len(paths._directories)):
+            raise ValueError("corrupt tables")
+        if packed < length:
+            # the last names haven't been packed yet
+            last = chunks.pop()
+            starts = paths._offsets[packed:]
+            paths._pending = [
+                last[start:end] for start, end in
+                zip(starts, list(starts[1:]) + [len(last)])]
+            del paths._offsets[packed:]
+        paths._chunks = chunks
+        return paths
+
+    def __eq__(self, other):
+        if isinstance(other, (PathList, list, tuple)):
+            return len(self) == len(other) and all(
+                mine == theirs for mine, theirs in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return 'PathList({0!r})'.format(list(self))
 
 
 class Playlist:
@@ -16,69 +230,268 @@ class Playlist:
     class UnsupportedPlaylistFormat(Exception):
         pass
 
-    def __init__(self, playlist, musicdir=None):
-        """Parse playlist."""
-        files = []
+    def __init__(self, playlist, musicdir=None, cache=None):
+        """Detect playlist format.
+
+        Only the first line is read here; entries are parsed on demand by
+        iter_files or get_files. With a cache.PlaylistCache as `cache`,
+        entries of unchanged playlists are read from there instead.
+        """
+        self.playlist = path.expanduser(playlist)
+        self.musicdir = musicdir
+        self.cache = cache
+        self.files = None
         # might throw FileNotFoundError
-        with open(path.expanduser(playlist)) as ofile:
-            for line in ofile:
-                files.append(line.rstrip())
+        with open(self.playlist) as ofile:
+            first_line = ofile.readline().rstrip()
         # try to guess playlist format from file content
-        if match(r"^#EXTM3U", files[0]):
-            # m3u playlist
-            self._parse_m3u(files, musicdir)
-        elif match(r".*(http://xspf.org/ns)", files[0]):
-            # xspf playlist
-            self._parse_xspf(files, musicdir)
+        if match(r"^#EXTM3U", first_line):
+            self.format = 'm3u'
+        elif match(r".*(http://xspf.org/ns)", first_line):
+            self.format = 'xspf'
         else:
-            self._parse_by_extension(playlist, files, musicdir)
+            self.format = self._format_by_extension(playlist)
 
-    def _parse_by_extension(self, filename, files, musicdir):
+    def _format_by_extension(self, filename):
         """Try to get playlist format from file extension."""
         if match(r".*\.m3u", filename):
-            self._parse_m3u(files, musicdir)
+            return 'm3u'
         elif match(r".*\.xspf", filename):
-            self._parse_xspf(files, musicdir)
+            return 'xspf'
         else:
             raise self.UnknownPlaylistFormat
 
-    def _parse_m3u(self, playlist, musicdir):
+    def _prefix(self, line):
+        """Prefix relative path with musicdir."""
+        if line[0] != "/":
+            if self.musicdir:
+                line = self.musicdir + "/" + line
+        return line
+
+    def _location(self, uri):
+        """Get file path from xspf location URI."""
+        uri = uri.strip()
+        if uri.startswith("file://"):
+            # drop the authority part, which is either empty or localhost;
+            # without a path after it, as in file://song.flac, it's taken
+            # for a relative path
+            slash = uri.find("/", 7)
+            uri = uri[7:] if slash < 0 else uri[slash:]
+        elif URI_SCHEME.match(uri):
+            # not a local file, leave it to copy_to to complain about it
+            return uri
+        if "%" in uri:
+            from urllib.parse import unquote
+            uri = unquote(uri)
+        return self._prefix(uri)
+
+    def _parse_m3u(self, playlist):
         """Get file paths from m3u playlist."""
-        lines = []
         for line in playlist:
-            if not match(r"^#", line):
-                if line[0] != "/":
-                    if musicdir:
-                        line = musicdir + "/" + line
-                lines.append(line)
-        self.files = lines
-
-    def _parse_xspf(self, playlist, musicdir):
+            line = line.rstrip()
+            if line and not match(r"^#", line):
+                yield self._prefix(line)
+
+    def _parse_xspf(self, playlist):
         """Get file paths from xspf playlist."""
-        # check if beautifulsoup is installed
+        # only needed for xspf, so keep it off the start-up path of m3u jobs
+        from xml.etree.ElementTree import iterparse, ParseError
+        count = 0
+        tracklist = None
+        try:
+            for event, elem in iterparse(playlist, events=('start', 'end')):
+                tag = elem.tag.rpartition('}')[2]
+                if event == 'start':
+                    if tag == 'trackList':
+                        tracklist = elem
+                elif tag == 'location' and elem.text:
+                    count += 1
+                    yield self._location(elem.text)
+                elif tag == 'track' and tracklist is not None:
+                    # drop parsed tracks to keep memory usage flat
+                    tracklist.clear()
+        except ParseError as e:
+            # fall back to the more lenient Beautiful Soup if it's available
+            playlist.seek(0)
+            for file in islice(self._parse_xspf_soup(playlist, e), count,
+                               None):
+                yield file
+
+    def _parse_xspf_soup(self, playlist, error):
+        """Get file paths from malformed xspf playlist."""
         try:
             from bs4 import BeautifulSoup
         except ImportError:
             msg = (
-                "For XSPF support, the 'Beautiful Soup' python library is "
-                "required.")
+                "Malformed XSPF playlist ({0}). For parsing it anyway, the "
+                "'Beautiful Soup' python library is required.".format(error))
             raise self.UnsupportedPlaylistFormat(msg)
 
-        lines = []
-        soup = BeautifulSoup(''.join(playlist))
+        soup = BeautifulSoup(playlist.read())
         for location in soup.findAll('location'):
-            line = sub(r"file://", "", location.contents[0])
-            if line[0] != "/":
-                if musicdir:
-                    line = musicdir + "/" + line
-            lines.append(line)
-        self.files = lines
+            if location.contents:
+                yield self._location(location.contents[0])
+
+    def iter_files(self):
+        """Yield files in playlist as they are parsed."""
+        if self.files is None and self.cache is not None:
+            entry = self._load_cached()
+        if self.files is not None:
+            for file in self.files:
+                yield file
+            return
+        if self.cache is None:
+            for file in self._parse():
+                yield file
+            return
+        files = PathList()
+        for file in self._parse():
+            files.append(file)
+            yield file
+        self.files = files
+        # don't cache what's been parsed if the playlist has changed since
+        if self.cache.entry(self.playlist, self.musicdir) == entry:
+            self.cache.store(entry, files)
+
+    def _load_cached(self):
+        """Get files from the cache if it has them; returns the cache entry."""
+        entry = self.cache.entry(self.playlist, self.musicdir)
+        self.files = self.cache.load(entry)
+        return entry
+
+    def _parse(self):
+        """Yield files parsed from playlist."""
+        if self.format == 'xspf':
+            # let the XML parser take care of the document's encoding
+            with open(self.playlist, 'rb') as ofile:
+                for file in self._parse_xspf(ofile):
+                    yield file
+        else:
+            with open(self.playlist) as ofile:
+                for file in self._parse_m3u(ofile):
+                    yield file
 
     def get_files(self):
-        """Return list of files in playlist."""
+        """Return files in playlist as a PathList."""
+        if self.files is None and self.cache is not None:
+            self._load_cached()
+        if self.files is None:
+            if self.cache is None:
+                self.files = PathList(self.iter_files())
+            else:
+                # iter_files keeps the files it parses for the cache
+                deque(self.iter_files(), maxlen=0)
         return self.files
 
 
+class Stats:
+
+    """Byte-level progress and throughput of a copy job."""
+
+    # time spans in seconds for the instantaneous and the average rate
+    RATE_WINDOW = 2
+    AVERAGE_WINDOW = 30
+    # minimum time between two samples
+    SAMPLE_INTERVAL = 0.1
+
+    def __init__(self):
+        """Initialisation."""
+        self.total_bytes = 0
+        self.copied_bytes = 0
+        self.start = monotonic()
+        # (time, copied_bytes) samples covering the last AVERAGE_WINDOW
+        self.samples = deque([(self.start, 0)])
+        self._lock = Lock()
+
+    def plan(self, nbytes):
+        """Add bytes to the total amount of data to copy."""
+        with self._lock:
+            self.total_bytes += nbytes
+
+    def skip(self, nbytes):
+        """Remove bytes which won't be copied after all from the total."""
+        with self._lock:
+            self.total_bytes -= nbytes
+
+    def add(self, nbytes):
+        """Record copied bytes."""
+        now = monotonic()
+        with self._lock:
+            self.copied_bytes += nbytes
+            if now - self.samples[-1][0] >= self.SAMPLE_INTERVAL:
+                self.samples.append((now, self.copied_bytes))
+                while now - self.samples[0][0] > self.AVERAGE_WINDOW:
+                    self.samples.popleft()
+
+    def _rate(self, now, window):
+        """Return bytes per second copied during the last window seconds."""
+        for then, copied in self.samples:
+            if now - then <= window:
+                break
+        if now - then <= 0:
+            return 0.0
+        return (self.copied_bytes - copied) / (now - then)
+
+    def get(self):
+        """Return dictionary with current statistics.
+
+        Rates are in bytes per second, eta and elapsed in seconds; eta is None
+        as long as nothing has been copied.
+        """
+        now = monotonic()
+        with self._lock:
+            rate = self._rate(now, self.RATE_WINDOW)
+            average_rate = self._rate(now, self.AVERAGE_WINDOW)
+            remaining = max(self.total_bytes - self.copied_bytes, 0)
+            return {
+                'total_bytes': self.total_bytes,
+                'copied_bytes': self.copied_bytes,
+                'rate': rate,
+                'average_rate': average_rate,
+                'eta': remaining / average_rate if average_rate else None,
+                'elapsed': now - self.start,
+            }
+
+
+class Plan:
+
+    """Outcome of the planning pass over a list of files."""
+
+    def __init__(self, files):
+        """Initialisation."""
+        self.files = files
+        self.sizes = [0] * len(files)
+        self.devices = [None] * len(files)
+        # index -> reason for files which can't be copied
+        self.problems = {}
+        self.total_bytes = 0
+        self.needed_bytes = 0
+        self.free_bytes = 0
+
+
+def _inspect(files):
+    """Return (size, device, problem) for each of files."""
+    results = []
+    for file in files:
+        try:
+            file_stat = stat(file)
+        except FileNotFoundError:
+            results.append((0, None, "unable to find file"))
+            continue
+        except OSError as e:
+            results.append((0, None, "unable to read file ({0})".format(
+                e.strerror)))
+            continue
+        if not S_ISREG(file_stat.st_mode):
+            problem = "not a regular file"
+        elif not access(file, R_OK):
+            problem = "insufficient permissions to read file"
+        else:
+            problem = None
+        results.append((file_stat.st_size, file_stat.st_dev, problem))
+    return results
+
+
 class SquarePig:
 
     """Main class."""
@@ -90,6 +503,19 @@ class SquarePig:
         self.error = None
         self.stop = False
         self.failed = []
+        self.skipped = []
+        self.backends = {}
+        self.listeners = []
+        self.stats = Stats()
+        self._journal = None
+        self._content_index = None
+        self._committer = None
+        self._transcoder = None
+        self._checksums = None
+        self._sums = {}
+        self._digests = {}
+        self._previous_sums = ({}, 0)
+        self._lock = Lock()
 
     class CopyError(Exception):
         def __init__(self, value):
@@ -98,10 +524,50 @@ class SquarePig:
         def __str__(self):
             return str(self.value)
 
-    def copy_to(self, files, destination):
-        """Copy files to destination."""
-        self.failed = []
-        if not path.isdir(path.expanduser(destination)):
+    def add_listener(self, listener):
+        """Register callable to be notified of progress.
+
+        Listeners are called with an event name and its data:
+
+        * 'state': the new state
+        * 'progress': tuple like the one returned by get_progress
+        * 'copied', 'skipped', 'failed': index of the file in question
+        * 'verified': index of a file verify found intact
+
+        File events are sent from the worker threads of copy_to, so listeners
+        have to be thread-safe.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Unregister listener."""
+        self.listeners.remove(listener)
+
+    def _notify(self, event, data):
+        """Notify listeners of event."""
+        for listener in self.listeners:
+            listener(event, data)
+
+    def _set_state(self, state):
+        """Change state and notify listeners."""
+        self.state = state
+        self._notify('state', state)
+
+    def _set_progress(self, progress):
+        """Change progress and notify listeners if it moved."""
+        if progress != self.progress:
+            self.progress = progress
+            self._notify('progress', progress)
+
+    def _file_done(self, event, count, results):
+        """Record outcome of a single file and notify listeners."""
+        with self._lock:
+            results.append(count)
+        self._notify(event, count)
+
+    def _create_destination(self, destination):
+        """Create destination directory if it doesn't exist yet."""
+        if not path.isdir(destination):
             try:
                 makedirs(destination)
             except PermissionError:
@@ -111,61 +577,813 @@ class SquarePig:
                 raise self.CopyError(msg)
             except FileNotFoundError:
                 msg = "Invalid DESTINATION path: {0}".format(destination)
-                self.state = 'stopped'
+                self._set_state('stopped')
                 self.error = msg
                 raise self.CopyError(msg)
+
+    @staticmethod
+    def _target_name(count, width, file):
+        """Return numbered target file name for file at position count."""
+        # TODO: Add numbering to last part of name
+        return str(count).zfill(width) + "_" + path.basename(file)
+
+    def _export_name(self, file):
+        """Return file with the name it gets at the destination."""
+        if self._transcoder is None:
+            return file
+        return self._transcoder.target_name(file)
+
+    @staticmethod
+    def _up_to_date(file, target, checksum=False):
+        """Check if target already holds an identical copy of file."""
+        try:
+            source_stat = stat(file)
+            target_stat = stat(target)
+        except FileNotFoundError:
+            return False
+        if source_stat.st_size != target_stat.st_size:
+            return False
+        if checksum:
+            return (hash_file(file, 'sha256') ==
+                    hash_file(target, 'sha256'))
+        return abs(source_stat.st_mtime - target_stat.st_mtime) < MTIME_WINDOW
+
+    def _delete_stale(self, destination, targets):
+        """Remove numbered files which aren't part of the playlist anymore."""
+        for name in listdir(destination):
+            filename = path.join(destination, name)
+            if (match(r"^\d+_", name) and name not in targets and
+                    path.isfile(filename)):
+                try:
+                    remove(filename)
+                except OSError as e:
+                    stderr.write('unable to delete {0}: {1}\n'.format(
+                        filename, e))
+
+    @staticmethod
+    def _remove_temps(destination):
+        """Remove incomplete targets left behind by interrupted jobs."""
+        for name in listdir(destination):
+            if is_temp_name(name):
+                try:
+                    remove(path.join(destination, name))
+                except OSError as e:
+                    stderr.write('unable to delete {0}: {1}\n'.format(
+                        name, e))
+
+    def _pad_targets(self, destination, names):
+        """Rename streamed targets once the number of files is known."""
+        width = len(str(len(names)))
+        if width == 1:
+            return
+        for count, name in enumerate(names):
+            source = path.join(destination, self._target_name(count, 1, name))
+            target = path.join(destination,
+                               self._target_name(count, width, name))
+            try:
+                rename(source, target)
+            except FileNotFoundError:
+                # file failed to copy
+                continue
+            if count in self._digests:
+                # the index has to know the target under its final name
+                self._content_index.add(self._digests[count], target)
+
+    @staticmethod
+    def _size(file):
+        """Return size of file or 0 if it can't be read."""
+        try:
+            return stat(file).st_size
+        except OSError:
+            return 0
+
+    def plan(self, files, destination, mode='copy', jobs=PLAN_JOBS):
+        """Stat all files and work out how much space copying them needs.
+
+        Files are inspected by `jobs` threads in parallel, since on network
+        storage most of the time is spent waiting for replies. Returns a Plan;
+        destination has to exist already.
+        """
+        if not hasattr(files, '__len__'):
+            files = list(files)
+        plan = Plan(files)
+        batches = [files[i:i + PLAN_BATCH]
+                   for i in range(0, len(files), PLAN_BATCH)]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = chain.from_iterable(executor.map(_inspect, batches))
+            for index, (size, device, problem) in enumerate(results):
+                plan.sizes[index] = size
+                plan.devices[index] = device
+                if problem:
+                    plan.problems[index] = problem
+                else:
+                    plan.total_bytes += size
+
+        # targets which already exist get overwritten, freeing their space
+        width = len(str(len(files)))
+        existing = set(listdir(destination))
+        destination_device = stat(destination).st_dev
+        for index, file in enumerate(files):
+            if index in plan.problems or mode in LINK_MODES:
+                continue
+            if mode == 'auto' and plan.devices[index] == destination_device:
+                # will be hard linked
+                continue
+            needed = plan.sizes[index]
+            name = self._target_name(index, width, file)
+            if name in existing:
+                target_stat = lstat(path.join(destination, name))
+                if S_ISREG(target_stat.st_mode):
+                    needed = max(needed - target_stat.st_size, 0)
+            plan.needed_bytes += needed
+        plan.free_bytes = disk_usage(destination).free
+        return plan
+
+    def _resumed(self, count, file, target, size):
+        """Check if file has been copied by an earlier run of the job."""
+        if self._journal.finished(count, file) != size:
+            return False
+        try:
+            return stat(target).st_size == size
+        except FileNotFoundError:
+            return False
+
+    def _adopt_short_name(self, count, file, target):
+        """Give work of an interrupted streamed job its padded name.
+
+        Streamed jobs number targets without padding until they're done, so
+        a resumed job finds finished and partial targets under those names.
+        """
+        if (self._journal.finished(count, file) is None and
+                not self._journal.offset(count, file)):
+            return
+        directory, name = path.split(target)
+        short = path.join(directory,
+                          self._target_name(count, 1, name.split('_', 1)[1]))
+        if short == target:
+            return
+        for old, new in [(short, target),
+                         (temp_name(short), temp_name(target))]:
+            if path.lexists(old):
+                rename(old, new)
+
+    def _clone_earlier(self, file_digest, target, temp, hasher=None):
+        """Link temp to an earlier export with the same content as target.
+
+        Returns the backend used or None if the file has to be copied.
+        """
+        earlier = self._content_index.lookup(file_digest)
+        if earlier is None or earlier == path.abspath(target):
+            return None
+        try:
+            return clone_file(earlier, temp, self.stats.add, hasher)
+        except Unsupported:
+            return None
+
+    def _load_checksums(self, destination):
+        """Remember and remove manifests of an earlier job in destination.
+
+        Targets change from here on, so they'd be stale; the checksums of
+        targets which are left alone can still be reused.
+        """
+        found = find_manifest(destination)
+        self._previous_sums = ({}, 0)
+        if found is not None and found[0] == self._checksums:
+            try:
+                self._previous_sums = (read_manifest(found[1]),
+                                       stat(found[1]).st_mtime_ns)
+            except (OSError, ValueError, UnicodeDecodeError):
+                pass
+        for name in MANIFESTS.values():
+            remove_manifest(path.join(destination, name))
+
+    def _record_existing(self, count, target):
+        """Record checksum of a target which has been skipped."""
+        if self._checksums is None:
+            return
+        previous, written = self._previous_sums
+        name = path.basename(target)
+        # the manifest only knows targets which haven't changed since
+        if name in previous and stat(target).st_ctime_ns <= written:
+            checksum = previous[name]
+        else:
+            checksum = hash_file(target, self._checksums)
+        with self._lock:
+            self._sums[count] = checksum
+
+    def _write_checksums(self, destination, names):
+        """Write manifest of targets with the given names in destination."""
+        manifest = path.join(destination, MANIFESTS[self._checksums])
+        temp = write_manifest(manifest, {
+            names[count]: checksum for count, checksum in self._sums.items()})
+        self._committer.commit(temp, manifest, 0, lambda: None)
+        self._committer.flush()
+
+    def _copy_file(self, count, file, target, destination, size=None,
+                   sync=False, checksum=False, mode='copy', origin=None):
+        """Copy a single file; run by the worker threads of copy_to.
+
+        If origin is given, data is read from there instead of from file.
+        """
+        # what's put at target and what sync compares target with
+        source = origin or file
+        reference = file
+        try:
+            if size is None:
+                # copying a streamed playlist, so the file hasn't been
+                # planned yet
+                size = self._size(file)
+                self.stats.plan(size)
+            if (origin is None and self._transcoder is not None and
+                    self._transcoder.profile_for(file) is not None):
+                source = reference = self._transcoder.transcode(file)
+                # encoded files are plain copies from the cache
+                mode = 'copy'
+                encoded_size = self._size(source)
+                self.stats.plan(encoded_size - size)
+                size = encoded_size
+            self._adopt_short_name(count, file, target)
+            if ((sync and self._up_to_date(reference, target, checksum)) or
+                    self._resumed(count, file, target, size)):
+                self._record_existing(count, target)
+                self.stats.skip(size)
+                self._file_done('skipped', count, self.skipped)
+                return count
+            # targets are written under a temporary name and only renamed
+            # once complete, so there's never a truncated target
+            temp = temp_name(target)
+            offset = min(self._journal.offset(count, file), self._size(temp))
+            # bytes which are already there don't need to be copied again
+            self.stats.skip(offset)
+            file_digest = None
+            backend = None
+            hasher = None
+            if self._checksums is not None:
+                hasher = new_hash(self._checksums)
+            if self._content_index is not None and mode not in LINK_MODES:
+                file_digest = self._content_index.digest(source)
+                backend = self._clone_earlier(file_digest, target, temp,
+                                              hasher)
+            if backend is None:
+                backend = export_file(
+                    source, temp, mode, self.stats.add, offset,
+                    lambda synced: self._journal.record_partial(
+                        count, synced, file), hasher)
+            link = backend in ['hardlink', 'symlink']
+            if sync and not link:
+                # keep modification time so the next sync can compare it
+                source_stat = stat(reference)
+                utime(temp, ns=(source_stat.st_atime_ns,
+                                source_stat.st_mtime_ns))
+
+            def committed():
+                if file_digest is not None:
+                    self._content_index.add(file_digest, target)
+                    with self._lock:
+                        self._digests[count] = file_digest
+                if hasher is not None:
+                    with self._lock:
+                        self._sums[count] = hasher.hexdigest()
+                self._journal.record_done(count, size, file)
+
+            self._committer.commit(temp, target, size, committed,
+                                   data=not link)
+            with self._lock:
+                self.backends[count] = backend
+            self._notify('copied', count)
+        except PermissionError:
+            msg = (
+                "Insufficient permissions to copy {file} to DESTINATION "
+                "directory {dest}".format(file=file, dest=destination))
+            raise self.CopyError(msg)
+        except Unsupported as e:
+            msg = (
+                "Unable to {mode} {file} to DESTINATION directory {dest}: "
+                "{error}".format(mode=mode, file=file, dest=destination,
+                                 error=e))
+            raise self.CopyError(msg)
+        except FileNotFoundError:
+            self.stats.skip(size or 0)
+            self._file_done('failed', count, self.failed)
+            msg = "unable to find file: {0}".format(file)
+            stderr.write('{0}\n'.format(msg))
+        except Transcoder.Error as e:
+            self.stats.skip(size or 0)
+            self._file_done('failed', count, self.failed)
+            stderr.write('unable to transcode {0}: {1}\n'.format(file, e))
+        return count
+
+    def _write_file(self, count, file, name, writer):
+        """Write a single file to writer; run by the workers of copy_to."""
+        source = file
+        [(size, device, problem)] = _inspect([file])
+        if problem:
+            self._file_done('failed', count, self.failed)
+            stderr.write('{0}: {1}\n'.format(problem, file))
+            return count
+        self.stats.plan(size)
+        try:
+            if (self._transcoder is not None and
+                    self._transcoder.profile_for(file) is not None):
+                source = self._transcoder.transcode(file)
+                encoded_size = self._size(source)
+                self.stats.plan(encoded_size - size)
+                size = encoded_size
+            backend = writer.write(name, source, self.stats.add)
+            with self._lock:
+                self.backends[count] = backend
+            self._notify('copied', count)
+        except Writer.Error as e:
+            msg = (
+                "Unable to write {file} to DESTINATION {dest}: "
+                "{error}".format(file=file, dest=writer, error=e))
+            raise self.CopyError(msg)
+        except OSError as e:
+            # writers raise OSError for problems with the source only
+            self.stats.skip(size)
+            self._file_done('failed', count, self.failed)
+            stderr.write('unable to read file ({0}): {1}\n'.format(
+                e.strerror, file))
+        except Transcoder.Error as e:
+            self.stats.skip(size)
+            self._file_done('failed', count, self.failed)
+            stderr.write('unable to transcode {0}: {1}\n'.format(file, e))
+        return count
+
+    def _copy_remote(self, files, writer, jobs, executor):
+        """Copy files to a Writer, see copy_to."""
+        if not hasattr(files, '__len__'):
+            files = list(files)
         file_count = len(files)
-        max_zeroes = len(str(file_count)) - 1
-        ten = 10
-        self.state = 'running'
-        for count, file in enumerate(files):
-            if self.stop:
-                self.stop = False
-                self.state = 'stopped'
-                return
-            # TODO: Add numbering to last part of name
-            zero_string = ""
-            for zero in range(max_zeroes):
-                zero_string += "0"
-            padding = (zero_string + str(count))
-            if count == (ten - 1):
-                ten *= 10
-                max_zeroes = int(max_zeroes) - 1
-            target = destination + "/" + padding + "_" + path.basename(file)
+        width = len(str(file_count))
+        finished = [False] * file_count
+        try:
+            writer.prepare()
+        except Writer.Error as e:
+            msg = "Unable to create DESTINATION {0}: {1}".format(writer, e)
+            self.error = msg
+            self._set_state('stopped')
+            raise self.CopyError(msg)
+        tasks = (partial(self._write_file, count, file, self._target_name(
+            count, width, self._export_name(file)), writer)
+            for count, file in enumerate(files))
+        # keep every connection of the writer busy
+        jobs = max(1, jobs, writer.connections)
+        self._set_progress((0, file_count))
+        self._set_state('running')
+        try:
+            if executor is None:
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    self._run(executor, tasks, finished, file_count, jobs)
+            else:
+                self._run(executor, tasks, finished, file_count, jobs)
+        finally:
             try:
-                self.progress = (count, file_count)
-                copy(file, target)
-                #percent = int(count / file_count * 100)
-                #stdout.write("                      \r")
-                #stdout.write("Copying files: {0}/{1}\r".format(count, file_count))
-                # XXX: DEBUG output
-                print("Copying files: {0}/{1}".format(count + 1, file_count))
-            except PermissionError:
-                msg = (
-                    "Insufficient permissions to copy {file} to DESTINATION "
-                    "directory {dest}".format(file=file, dest=destination))
-                self.state = 'stopped'
+                writer.close()
+            except Writer.Error as e:
+                msg = "Unable to finish DESTINATION {0}: {1}".format(
+                    writer, e)
                 self.error = msg
+                self._set_state('stopped')
                 raise self.CopyError(msg)
-            except FileNotFoundError:
-                self.failed.append(count)
-                msg = "unable to find file: {0}".format(file)
-                # self.state = 'stopped'
-                # self.error = msg
-                # raise self.CopyError(msg)
-                stderr.write('{0}\n'.format(msg))
+        self.failed.sort()
+        if self.stop:
+            self.stop = False
+            self._set_state('stopped')
+            return
+        self._set_progress((file_count, file_count))
+        self._set_state('done')
+        if len(self.failed) > 0:
+            stderr.write('failed to copy {0} files\n'.format(
+                len(self.failed)))
+
+    def _preflight(self, files, destination, mode):
+        """Plan copying files and fail early if it can't work out."""
+        plan = self.plan(files, destination, mode)
+        if plan.needed_bytes > plan.free_bytes:
+            msg = (
+                "Insufficient space in DESTINATION directory {dest}: "
+                "{needed:.1f} MB needed, {free:.1f} MB free".format(
+                    dest=destination, needed=plan.needed_bytes / 1000 ** 2,
+                    free=plan.free_bytes / 1000 ** 2))
+            self.error = msg
+            self._set_state('stopped')
+            raise self.CopyError(msg)
+        for index in sorted(plan.problems):
+            self._file_done('failed', index, self.failed)
+            stderr.write('{0}: {1}\n'.format(plan.problems[index],
+                                              files[index]))
+        self.stats.plan(plan.total_bytes)
+        return plan
+
+    def _open_journal(self, destination, resume):
+        """Open journal of copy job in destination."""
+        try:
+            self._journal = Journal(destination, resume)
+        except OSError as e:
+            msg = "Unable to write journal to DESTINATION {0}: {1}".format(
+                destination, e.strerror)
+            self.error = msg
+            self._set_state('stopped')
+            raise self.CopyError(msg)
+
+    @staticmethod
+    def _submit(executor, task):
+        """Submit task to executor.
+
+        Tasks may also be (future, task) tuples, which get submitted once
+        future is done, with the result of future as argument.
+        """
+        if not isinstance(task, tuple):
+            return executor.submit(task)
+        after, task = task
+        future = Future()
+
+        def forward(inner):
+            if inner.exception() is not None:
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+
+        def start(after):
+            if future.set_running_or_notify_cancel():
+                executor.submit(task, after.result()).add_done_callback(
+                    forward)
+
+        after.add_done_callback(start)
+        return future
+
+    def _run(self, executor, tasks, finished, file_count, jobs):
+        """Run tasks on executor until done or stopped.
+
+        Tasks return the index of the file they took care of, or a list of
+        indices for batches of files, which get marked in finished.
+        file_count is None while files are streamed.
+        """
+        # progress points at the first file which hasn't been finished yet,
+        # so everything before it is known to be done
+        first_pending = 0
+        window = jobs * 2
+        pending = set()
+        try:
+            while not self.stop:
+                for task in islice(tasks, window - len(pending)):
+                    pending.add(self._submit(executor, task))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    for index in (result if isinstance(result, list)
+                                  else [result]):
+                        finished[index] = True
+                while (first_pending < len(finished) and
+                       finished[first_pending]):
+                    first_pending += 1
+                self._set_progress((first_pending,
+                                    file_count or len(finished)))
+        except self.CopyError as e:
+            self.error = str(e)
+            self._set_state('stopped')
+            raise
+        finally:
+            # copies which are already running are allowed to finish
+            for future in pending:
+                future.cancel()
+            wait(pending)
+
+    @staticmethod
+    def _schedule(files, plan):
+        """Order files of a planned job for copying.
+
+        Files get a queue per source device, and the queues take turns, so
+        every device has copies running instead of one device being busy
+        with a stretch of the playlist while the others sit idle. Runs of
+        small files on a device are grouped into batches. Yields lists of
+        (index, file) pairs; target names are unaffected by the order.
+        """
+        devices = {}
+        for count, file in enumerate(files):
+            if count in plan.problems:
                 continue
+            groups = devices.setdefault(plan.devices[count], [])
+            small = plan.sizes[count] < SMALL_FILE
+            if (small and groups and len(groups[-1]) < SMALL_BATCH and
+                    plan.sizes[groups[-1][-1][0]] < SMALL_FILE):
+                groups[-1].append((count, file))
+            else:
+                groups.append([(count, file)])
+        queues = deque(iter(groups) for groups in devices.values())
+        while queues:
+            queue = queues.popleft()
+            for group in queue:
+                yield group
+                queues.append(queue)
+                break
+
+    def _copy_batch(self, tasks):
+        """Run tasks copying small files one after another.
+
+        Returns the indices of the files which have been taken care of.
+        """
+        indices = []
+        for task in tasks:
+            if self.stop:
+                break
+            indices.append(task())
+        return indices
+
+    def _copy_shared(self, task, target, shared):
+        """Run task copying a file other copies are made from.
+
+        The shared future gets the target once it's there, or None if the
+        others have to copy from the source after all.
+        """
+        count = None
+        try:
+            count = task()
+        finally:
+            copied = False
+            if count is not None:
+                # the target may still be waiting for its batch under its
+                # temporary name, with an old target in its place
+                self._committer.flush()
+                with self._lock:
+                    copied = count in self.backends or count in self.skipped
+            resolve(shared, target if copied else None)
+        return count
+
+    def copy_to(self, files, destination, jobs=1, sync=False, checksum=False,
+                delete=False, mode='copy', preflight=False, resume=False,
+                executor=None, sources=None, content_index=None,
+                durability='none', transcoder=None, checksums=None):
+        """Copy files to destination.
+
+        Up to `jobs` files are copied concurrently. Target names are numbered
+        in playlist order regardless of the order in which copies finish.
+        If the list of files is known up front, files on different devices
+        are copied side by side and small files in batches, see _schedule.
+
+        In `sync` mode targets which already match their source in size and
+        modification time - or content if `checksum` is set - are skipped.
+        With `delete`, numbered files in destination which aren't part of the
+        playlist are removed after a complete run.
+
+        `mode` is one of copyfile.MODES and decides whether files get copied
+        or linked to their source.
+
+        If the list of files is known up front, all of them are checked
+        before anything is copied: missing files are reported as failed
+        right away and a CopyError is raised if they won't fit into
+        destination. `preflight` reads the whole of a streamed list first to
+        make this possible.
+
+        Files are written under temporary names and renamed once complete;
+        `durability` is one of durable.DURABILITY and decides how they are
+        synced to disk, see durable.Committer.
+
+        A transcode.Transcoder as `transcoder` encodes the files its rules
+        match, which then get its extension; at least as many files as it
+        runs encoders at once are worked on concurrently.
+
+        Progress is recorded in a journal in destination until the job is
+        done. With `resume`, files an interrupted run of the same job has
+        finished are skipped and partially copied ones are continued.
+
+        `executor` and `sources` are used by batch.Batch for running several
+        jobs on a shared pool of worker threads: if given, copies are run on
+        executor instead of a pool of this job's own. sources maps indices of
+        files to (primary, future) pairs for files which are copied by
+        several jobs: only the primary copy reads the source and resolves
+        future with its target, from which the other copies are made.
+
+        With a cache.ContentIndex as `content_index`, files with the same
+        content as a target written before - by this or an earlier job - are
+        reflinked or hard linked to it instead of being copied, if possible.
+
+        `checksums`, one of checksums.ALGORITHMS, has the data of each file
+        hashed while it's copied - which rules out the backends copying
+        inside the kernel - and a manifest like SHA256SUMS written to
+        destination once the job is done, see verify. Without it, manifests
+        of earlier jobs are removed as they'd be out of date.
 
-        self.progress = (file_count, file_count)
-        self.state = 'done'
+        Instead of a local directory, destination may be a writers.Writer
+        or a URL understood by writers.open_writer, e.g. of an SFTP server.
+        Files are then copied over a pool of connections, at least one file
+        per connection at once; syncing, resuming, deleting, links and
+        content_index only work with local directories.
+        """
+        self.failed = []
+        self.skipped = []
+        self.backends = {}
+        self.stats = Stats()
+        try:
+            writer = open_writer(destination)
+        except Writer.Error as e:
+            self.error = str(e)
+            raise self.CopyError(str(e))
+        if writer is not None:
+            if (sync or delete or resume or mode != 'copy' or
+                    content_index is not None or checksums is not None):
+                msg = ("Only plain copies are supported for remote "
+                       "DESTINATION {0}".format(writer))
+                self.error = msg
+                raise self.CopyError(msg)
+            self._transcoder = transcoder
+            if transcoder is not None:
+                jobs = max(jobs, transcoder.jobs)
+            return self._copy_remote(files, writer, jobs, executor)
+        destination = path.expanduser(destination)
+        self._create_destination(destination)
+        if ((preflight or sync or delete or resume) and
+                not hasattr(files, '__len__')):
+            # planning, syncing and resuming need the final target names up
+            # front
+            files = list(files)
+        if hasattr(files, '__len__'):
+            file_count = len(files)
+            width = len(str(file_count))
+            plan = self._preflight(files, destination, mode)
+            sizes = plan.sizes
+            finished = [index in plan.problems for index in range(file_count)]
+            queue = self._schedule(files, plan)
+        else:
+            # files are still being parsed, so targets get numbered without
+            # padding and are renamed once the number of files is known
+            file_count = None
+            width = 1
+            sizes = None
+            finished = []
+            queue = ([item] for item in enumerate(files))
+        streamed = []
+
+        def tasks():
+            for group in queue:
+                batch = []
+                for count, file in group:
+                    if file_count is None:
+                        finished.append(False)
+                        streamed.append(path.basename(self._export_name(file)))
+                    target = path.join(destination, self._target_name(
+                        count, width, self._export_name(file)))
+                    task = partial(
+                        self._copy_file, count, file, target, destination,
+                        None if sizes is None else sizes[count], sync,
+                        checksum, mode)
+                    primary, shared = (sources or {}).get(count,
+                                                          (None, None))
+                    if shared is None:
+                        batch.append(task)
+                    elif primary:
+                        yield partial(self._copy_shared, task, target, shared)
+                    else:
+                        # copy from the target of the first copy once it's
+                        # done
+                        yield shared, task
+                if len(batch) == 1:
+                    yield batch[0]
+                elif batch:
+                    yield partial(self._copy_batch, batch)
+
+        self._content_index = content_index
+        self._committer = Committer(destination, durability)
+        self._transcoder = transcoder
+        if transcoder is not None:
+            jobs = max(jobs, transcoder.jobs)
+        self._checksums = checksums
+        self._sums = {}
+        self._digests = {}
+        self._open_journal(destination, resume)
+        self._load_checksums(destination)
+        self._set_progress((0, file_count or 0))
+        self._set_state('running')
+        try:
+            if executor is None:
+                with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+                    self._run(executor, tasks(), finished, file_count,
+                              max(1, jobs))
+            else:
+                self._run(executor, tasks(), finished, file_count,
+                          max(1, jobs))
+        finally:
+            try:
+                # files of an unfinished batch are complete, too
+                self._committer.flush()
+            finally:
+                self._journal.close()
+        self.failed.sort()
+        if self.stop:
+            # the number of files isn't known, so streamed targets keep
+            # their short names, which a resumed job picks up
+            self.stop = False
+            self._set_state('stopped')
+            return
+        if file_count is None:
+            file_count = len(finished)
+            width = len(str(file_count))
+            self._pad_targets(destination, streamed)
+
+        if checksums is not None:
+            self._write_checksums(destination, [
+                self._target_name(count, width, name) for count, name in
+                enumerate(streamed or map(self._export_name, files))])
+        self._journal.remove()
+        self._remove_temps(destination)
+        self.skipped.sort()
+        if delete:
+            self._delete_stale(destination, {
+                self._target_name(count, width, self._export_name(file))
+                for count, file in enumerate(files)})
+        self._set_progress((file_count, file_count))
+        self._set_state('done')
         if len(self.failed) > 0:
             stderr.write('failed to copy {0} files\n'.format(
                 len(self.failed)))
 
+    def _verify_file(self, count, target, expected, algorithm):
+        """Check a single target against its checksum for verify."""
+        try:
+            actual = hash_file(target, algorithm, self.stats.add)
+        except FileNotFoundError:
+            actual = None
+        if actual == expected:
+            self._notify('verified', count)
+        else:
+            self._file_done('failed', count, self.failed)
+            stderr.write('{0}: {1}\n'.format(
+                'checksum mismatch' if actual else 'unable to find file',
+                target))
+        return count
+
+    def verify(self, destination, jobs=1):
+        """Check targets in destination against the manifest of copy_to.
+
+        Only destination is read, by up to `jobs` threads in parallel.
+        Targets which are missing or don't match their checksum are reported
+        as failed, by their index in the playlist. Raises CopyError if
+        destination has no manifest.
+        """
+        self.failed = []
+        self.skipped = []
+        self.backends = {}
+        self.stats = Stats()
+        destination = path.expanduser(destination)
+        found = find_manifest(destination)
+        if found is None:
+            msg = "No checksums found in DESTINATION {0}".format(destination)
+            self.error = msg
+            raise self.CopyError(msg)
+        algorithm, manifest = found
+        try:
+            new_hash(algorithm)
+            expected = read_manifest(manifest)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            msg = "Unable to read {0}: {1}".format(manifest, e)
+            self.error = msg
+            raise self.CopyError(msg)
+        targets = {}
+        for name, checksum in expected.items():
+            number = match(r"^(\d+)_", name)
+            if number:
+                targets[int(number.group(1))] = (name, checksum)
+        file_count = max(targets, default=-1) + 1
+        finished = [count not in targets for count in range(file_count)]
+        for name, checksum in targets.values():
+            self.stats.plan(self._size(path.join(destination, name)))
+        tasks = (partial(self._verify_file, count,
+                         path.join(destination, name), checksum, algorithm)
+                 for count, (name, checksum) in sorted(targets.items()))
+        self._set_progress((0, file_count))
+        self._set_state('running')
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            self._run(executor, tasks, finished, file_count, max(1, jobs))
+        self.failed.sort()
+        if self.stop:
+            self.stop = False
+            self._set_state('stopped')
+            return
+        self._set_progress((file_count, file_count))
+        self._set_state('done')
+        if len(self.failed) > 0:
+            stderr.write('failed to verify {0} files\n'.format(
+                len(self.failed)))
+
     def get_failed(self):
         """Get failed files."""
         return self.failed
 
+    def get_backends(self):
+        """Get mapping of copied files to the backend which copied them."""
+        return self.backends
+
+    def get_skipped(self):
+        """Get files which were skipped because they were up to date."""
+        return self.skipped
+
+    def get_stats(self):
+        """Get byte-level progress and throughput, see Stats.get."""
+        return self.stats.get()
+
     def get_state(self):
         """Get current state."""
         return self.state
@@ -0,0 +1,119 @@
+"""Batch mode for Squarepig: run many copy jobs in one process."""
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from os import path
+
+from squarepig.backpig import SquarePig, resolve
+from squarepig.copyfile import LINK_MODES
+
+
+class Batch:
+
+    """Several copy jobs sharing one pool of worker threads.
+
+    Files which are part of more than one job are only read from their source
+    once; the other jobs copy - or, where possible, reflink or hard link -
+    the target of the first copy instead.
+    """
+
+    def __init__(self, jobs=1, **options):
+        """Initialisation.
+
+        jobs is the number of worker threads shared by all jobs, options are
+        passed on to SquarePig.copy_to.
+        """
+        self.jobs = jobs
+        self.options = options
+        self.entries = []
+        self.sargassos = []
+        self.errors = {}
+
+    def add(self, files, destination):
+        """Add job copying files to destination."""
+        if not hasattr(files, '__len__'):
+            files = list(files)
+        self.entries.append((files, destination))
+        self.sargassos.append(SquarePig())
+
+    def _share_sources(self):
+        """Work out which copies are made from other jobs' targets.
+
+        Returns a sources mapping for SquarePig.copy_to for each job and the
+        futures each job is responsible for.
+        """
+        sources = [{} for entry in self.entries]
+        owned = [[] for entry in self.entries]
+        if self.options.get('mode') in LINK_MODES:
+            # links are cheap enough already
+            return sources, owned
+        first = {}
+        for job, (files, destination) in enumerate(self.entries):
+            for count, file in enumerate(files):
+                key = path.realpath(file)
+                if key not in first:
+                    first[key] = (job, count, None)
+                    continue
+                owner, owner_count, shared = first[key]
+                if shared is None:
+                    shared = Future()
+                    first[key] = (owner, owner_count, shared)
+                    sources[owner][owner_count] = (True, shared)
+                    owned[owner].append(shared)
+                sources[job][count] = (False, shared)
+        return sources, owned
+
+    def _run_job(self, job, executor, sources, owned):
+        """Run a single job; runs in a thread of its own."""
+        files, destination = self.entries[job]
+        try:
+            self.sargassos[job].copy_to(
+                files, destination, jobs=self.jobs, executor=executor,
+                sources=sources, **self.options)
+        except Exception as e:
+            # e.g. a destination which can't be created, which must not go
+            # unnoticed among the other jobs
+            self.errors[job] = e
+        finally:
+            # let jobs waiting for files this one didn't get to copy them
+            # from their source
+            for shared in owned:
+                resolve(shared, None)
+
+    def run(self):
+        """Run all jobs.
+
+        Jobs only ever wait for files of jobs which have been added before
+        them and are started in that order, so they can't block each other.
+        Errors of jobs, usually CopyErrors, are collected in errors.
+        """
+        self.errors = {}
+        sources, owned = self._share_sources()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor, \
+                ThreadPoolExecutor(max_workers=self.jobs) as jobs:
+            wait([jobs.submit(self._run_job, job, executor, sources[job],
+                              owned[job])
+                  for job in range(len(self.entries))])
+
+    def request_stop(self):
+        """Tell all jobs to stop."""
+        for sargasso in self.sargassos:
+            sargasso.request_stop()
+
+    def get_progress(self):
+        """Get combined progress of all jobs."""
+        progress = [sargasso.get_progress() for sargasso in self.sargassos]
+        return (sum(index for index, length in progress),
+                sum(length for index, length in progress))
+
+    def get_stats(self):
+        """Get combined statistics of all jobs, see Stats.get."""
+        stats = [sargasso.get_stats() for sargasso in self.sargassos]
+        combined = {}
+        for key in ['total_bytes', 'copied_bytes', 'rate', 'average_rate']:
+            combined[key] = sum(job_stats[key] for job_stats in stats)
+        combined['elapsed'] = max(
+            [job_stats['elapsed'] for job_stats in stats] or [0])
+        remaining = max(combined['total_bytes'] - combined['copied_bytes'], 0)
+        combined['eta'] = (remaining / combined['average_rate']
+                           if combined['average_rate'] else None)
+        return combined
@@ -0,0 +1,248 @@
+"""Persistent caches of Squarepig."""
+
+import sqlite3
+from hashlib import blake2b
+from os import (
+    environ, getpid, listdir, makedirs, path, remove, replace, stat, utime)
+from threading import get_ident, Lock
+from time import time, time_ns
+
+from squarepig.checksums import update_from
+
+
+def cache_dir():
+    """Return Squarepig's directory below $XDG_CACHE_HOME, creating it."""
+    cache_home = environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache')
+    directory = path.join(cache_home, 'squarepig')
+    makedirs(directory, 0o755, exist_ok=True)
+    return directory
+
+
+def digest(filename):
+    """Return BLAKE2b hex digest of file content, read block by block."""
+    # shorter than the digests of checksums.hash_file, which the content
+    # index and the names of cached encodings were keyed with all along
+    content_hash = blake2b(digest_size=32)
+    update_from(filename, content_hash)
+    return content_hash.hexdigest()
+
+
+def touch(filename):
+    """Mark cache entry as used, leaving its modification time alone."""
+    utime(filename, ns=(time_ns(), stat(filename).st_mtime_ns))
+
+
+def evict(filenames, max_bytes):
+    """Remove least recently used files until the rest fit into max_bytes.
+
+    Files count as used when they've last been accessed, see touch.
+    """
+    entries = []
+    for filename in filenames:
+        try:
+            entry_stat = stat(filename)
+        except FileNotFoundError:
+            continue
+        entries.append((entry_stat.st_atime_ns, entry_stat.st_size,
+                        filename))
+    total = sum(size for used, size, filename in entries)
+    for used, size, filename in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            remove(filename)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+class ContentIndex:
+
+    """Content-addressed index of files written by earlier exports.
+
+    Maps content hashes to the last target written with that content, so a
+    repeated file can be linked to it instead of being copied again. Hashes
+    themselves are cached by device, inode, size and modification time, so
+    unchanged files are never read twice. Both tables are kept below a
+    maximum number of entries by evicting the least recently used ones.
+    """
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS hashes (
+            dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER,
+            digest TEXT, used REAL, PRIMARY KEY (dev, ino))''',
+        '''CREATE TABLE IF NOT EXISTS targets (
+            digest TEXT PRIMARY KEY, target TEXT, used REAL)''',
+        'CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)',
+        'CREATE INDEX IF NOT EXISTS targets_used ON targets (used)',
+    ]
+
+    # changes between two commits and checks for entries to evict
+    COMMIT_INTERVAL = 500
+
+    def __init__(self, filename=None, max_entries=200000):
+        """Open index, by default in the cache directory."""
+        if filename is None:
+            filename = path.join(cache_dir(), 'content.sqlite')
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self._db.execute(statement)
+        self._changes = 0
+        self._lock = Lock()
+
+    def _changed(self):
+        """Count change, committing and evicting every now and then."""
+        self._changes += 1
+        if self._changes >= self.COMMIT_INTERVAL:
+            self._evict()
+            self._db.commit()
+            self._changes = 0
+
+    def _evict(self):
+        """Drop least recently used entries above max_entries."""
+        for table in ['hashes', 'targets']:
+            count = self._db.execute(
+                'SELECT COUNT(*) FROM {0}'.format(table)).fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute(
+                    'DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} '
+                    'ORDER BY used LIMIT ?)'.format(table),
+                    (count - self.max_entries,))
+
+    def _remember(self, file_stat, file_digest):
+        """Cache digest of file described by file_stat."""
+        self._db.execute(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+            (file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+             file_stat.st_mtime_ns, file_digest, time()))
+        self._changed()
+
+    def digest(self, filename):
+        """Return content hash of file, hashing it only if it has changed."""
+        file_stat = stat(filename)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND '
+                'size = ? AND mtime = ?',
+                (file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+                 file_stat.st_mtime_ns)).fetchone()
+            if row:
+                self._db.execute(
+                    'UPDATE hashes SET used = ? WHERE dev = ? AND ino = ?',
+                    (time(), file_stat.st_dev, file_stat.st_ino))
+                self._changed()
+                return row[0]
+        file_digest = digest(filename)
+        with self._lock:
+            self._remember(file_stat, file_digest)
+        return file_digest
+
+    def lookup(self, file_digest):
+        """Return an existing target with the given content or None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT target FROM targets WHERE digest = ?',
+                (file_digest,)).fetchone()
+        if row is None:
+            return None
+        # the target is only trusted while its hash is cached for its current
+        # inode, size and modification time; changed targets are skipped
+        # rather than rehashed
+        try:
+            target_stat = stat(row[0])
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._db.execute(
+                'SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND '
+                'size = ? AND mtime = ?',
+                (target_stat.st_dev, target_stat.st_ino, target_stat.st_size,
+                 target_stat.st_mtime_ns)).fetchone()
+            if cached is None or cached[0] != file_digest:
+                return None
+            self._db.execute('UPDATE targets SET used = ? WHERE digest = ?',
+                             (time(), file_digest))
+            self._changed()
+        return row[0]
+
+    def add(self, file_digest, target):
+        """Record that target holds content with the given hash."""
+        target_stat = stat(target)
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO targets VALUES (?, ?, ?)',
+                (file_digest, path.abspath(target), time()))
+            self._remember(target_stat, file_digest)
+
+    def close(self):
+        """Write pending changes and close index."""
+        with self._lock:
+            self._evict()
+            self._db.commit()
+            self._db.close()
+
+
+class PlaylistCache:
+
+    """Parsed playlists, so unchanged playlists needn't be parsed again.
+
+    Each playlist is kept in a file of its own, holding a backpig.PathList
+    in its binary format. Files are named by a hash of the path, size and
+    modification time of the playlist and the music directory it has been
+    parsed with, so changed playlists simply miss the cache. Once entries
+    take up more than max_bytes, the least recently used ones are removed.
+    Failing to read or write the cache is never an error.
+    """
+
+    SUFFIX = '.idx'
+
+    def __init__(self, directory=None, max_bytes=64 << 20):
+        """Initialisation."""
+        if directory is None:
+            directory = path.join(cache_dir(), 'playlists')
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def entry(self, playlist, musicdir=None):
+        """Return name of the cache entry for playlist in its current state."""
+        playlist_stat = stat(playlist)
+        key = '\0'.join([path.realpath(playlist), str(playlist_stat.st_size),
+                         str(playlist_stat.st_mtime_ns), musicdir or ''])
+        name = blake2b(key.encode('utf-8', 'surrogateescape'),
+                       digest_size=16).hexdigest()
+        return path.join(self.directory, name + self.SUFFIX)
+
+    def load(self, entry):
+        """Return PathList stored in entry or None if there's none."""
+        from squarepig.backpig import PathList
+        try:
+            with open(entry, 'rb') as ofile:
+                files = PathList.load(ofile)
+            touch(entry)
+        except (OSError, ValueError):
+            return None
+        return files
+
+    def store(self, entry, files):
+        """Store PathList files in entry."""
+        temp = '{0}.{1}-{2}.part'.format(entry, getpid(), get_ident())
+        try:
+            makedirs(self.directory, 0o755, exist_ok=True)
+            with open(temp, 'wb') as ofile:
+                files.dump(ofile)
+            replace(temp, entry)
+            self._evict()
+        except OSError:
+            try:
+                remove(temp)
+            except OSError:
+                pass
+
+    def _evict(self):
+        """Remove least recently used entries above max_bytes."""
+        evict([path.join(self.directory, name)
+               for name in listdir(self.directory)
+               if name.endswith(self.SUFFIX)], self.max_bytes)
@@ -0,0 +1,104 @@
+"""Checksums of exported files and manifests listing them."""
+
+import hashlib
+import os
+from os import path
+
+from squarepig.durable import temp_name
+
+
+ALGORITHMS = ['sha256', 'blake2b', 'xxh64']
+
+# manifest names of coreutils' sha256sum and b2sum and of xxhsum
+MANIFESTS = {
+    'sha256': 'SHA256SUMS',
+    'blake2b': 'B2SUMS',
+    'xxh64': 'XXH64SUMS',
+}
+
+
+def _ignore_progress(nbytes):
+    """Default progress callback."""
+
+
+def new_hash(algorithm):
+    """Return new hash object of one of ALGORITHMS.
+
+    Raises ValueError for unknown algorithms and for xxh64 if the xxhash
+    library isn't installed.
+    """
+    if algorithm == 'xxh64':
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError(
+                "xxh64 checksums require the 'xxhash' python library.")
+        return xxhash.xxh64()
+    if algorithm not in ALGORITHMS:
+        raise ValueError("unknown checksum algorithm: {0}".format(algorithm))
+    return hashlib.new(algorithm)
+
+
+def update_from(filename, hasher, progress=_ignore_progress,
+                blocksize=1 << 20):
+    """Feed content of filename to hasher."""
+    with open(filename, 'rb') as ifile:
+        for block in iter(lambda: ifile.read(blocksize), b''):
+            hasher.update(block)
+            progress(len(block))
+
+
+def hash_file(filename, algorithm, progress=_ignore_progress):
+    """Return checksum of filename as hex string."""
+    hasher = new_hash(algorithm)
+    update_from(filename, hasher, progress)
+    return hasher.hexdigest()
+
+
+def find_manifest(directory):
+    """Return (algorithm, filename) of the manifest in directory or None."""
+    for algorithm in ALGORITHMS:
+        filename = path.join(directory, MANIFESTS[algorithm])
+        if path.isfile(filename):
+            return algorithm, filename
+    return None
+
+
+def read_manifest(filename):
+    """Return mapping of file names to checksums listed in a manifest.
+
+    Raises ValueError for lines which aren't in the format of sha256sum.
+    """
+    checksums = {}
+    with open(filename, encoding='utf-8') as ifile:
+        for number, line in enumerate(ifile, 1):
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            checksum, separator, name = line.partition(' ')
+            if not separator or name[:1] not in [' ', '*']:
+                raise ValueError("line {0}: expected CHECKSUM  NAME".format(
+                    number))
+            checksums[name[1:]] = checksum
+    return checksums
+
+
+def write_manifest(filename, checksums):
+    """Write manifest listing checksums, a mapping of names to checksums.
+
+    The manifest is written under a temporary name, which is returned, and
+    has to be moved into place by the caller.
+    """
+    temp = temp_name(filename)
+    with open(temp, 'w', encoding='utf-8') as ofile:
+        for name in sorted(checksums):
+            ofile.write('{0}  {1}\n'.format(checksums[name], name))
+    return temp
+
+
+def remove_manifest(filename):
+    """Remove manifest if there is one."""
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
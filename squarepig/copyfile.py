@@ -0,0 +1,308 @@
+"""File copy backends for Squarepig.
+
+Copies only file content - permission bits and timestamps are left alone -
+using the cheapest mechanism the platform offers: a reflink on copy-on-write
+file systems, then copy_file_range, sendfile and finally plain read/write.
+"""
+
+import errno
+import os
+from os import path
+from stat import S_ISLNK
+
+from squarepig.checksums import _ignore_progress, update_from
+
+try:
+    from fcntl import ioctl
+except ImportError:
+    # not available on this platform
+    ioctl = None
+
+
+# ioctl request for cloning a file on Linux, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+BLOCKSIZE = 1 << 20
+
+# amount of data copied by the kernel per system call; small enough to report
+# progress on large files every now and then
+CHUNKSIZE = 8 << 20
+
+# files from this size on are read ahead aggressively and copied in chunks of
+# CHUNKSIZE by the read/write fallback as well
+LARGE_FILE = 64 << 20
+
+# bytes between two checkpoints of a copy which may be resumed later
+CHECKPOINT = 64 << 20
+
+# errors meaning a backend can't be used for this pair of files
+UNSUPPORTED = {
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.ENOTSUP, errno.ENOTTY, errno.ENOTSOCK, errno.EBADF,
+}
+
+
+class Unsupported(Exception):
+
+    """Backend can't copy between these files."""
+
+
+def _reflink(infd, outfd, size, progress):
+    """Clone source into target, sharing data blocks."""
+    if ioctl is None:
+        raise Unsupported
+    try:
+        ioctl(outfd, FICLONE, infd)
+    except OSError as e:
+        if e.errno in UNSUPPORTED:
+            raise Unsupported(e)
+        raise
+    progress(size)
+
+
+def _copy_file_range(infd, outfd, size, progress):
+    """Copy data inside the kernel, possibly offloaded to the file system."""
+    if not hasattr(os, 'copy_file_range'):
+        raise Unsupported
+    remaining = size - os.lseek(infd, 0, os.SEEK_CUR)
+    copied = 0
+    while True:
+        try:
+            sent = os.copy_file_range(infd, outfd, CHUNKSIZE)
+        except OSError as e:
+            if copied == 0 and e.errno in UNSUPPORTED:
+                raise Unsupported
+            raise
+        if sent == 0:
+            if copied == 0 and remaining > 0:
+                # some FUSE and virtual file systems claim there's nothing
+                # to copy instead of failing
+                raise Unsupported
+            break
+        copied += sent
+        progress(sent)
+
+
+def _sendfile(infd, outfd, size, progress):
+    """Copy data inside the kernel."""
+    if not hasattr(os, 'sendfile'):
+        raise Unsupported
+    # sendfile doesn't move the file offset of infd, so keep track of it here
+    offset = os.lseek(infd, 0, os.SEEK_CUR)
+    copied = 0
+    while True:
+        try:
+            sent = os.sendfile(outfd, infd, offset + copied, CHUNKSIZE)
+        except OSError as e:
+            if copied == 0 and e.errno in UNSUPPORTED:
+                raise Unsupported
+            raise
+        if sent == 0:
+            break
+        copied += sent
+        progress(sent)
+
+
+def _read_write(fsrc, fdst, progress, blocksize=BLOCKSIZE, hasher=None):
+    """Copy data through userspace, feeding it to hasher if given."""
+    while True:
+        block = fsrc.read(blocksize)
+        if not block:
+            break
+        fdst.write(block)
+        if hasher is not None:
+            hasher.update(block)
+        progress(len(block))
+
+
+BACKENDS = [
+    ('reflink', _reflink),
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _sendfile),
+]
+
+
+def _make_way(target):
+    """Remove target if it's a link.
+
+    Opening it for writing would also change what it's linked to, e.g. the
+    source of a folder which has been exported with links before.
+    """
+    try:
+        target_stat = os.lstat(target)
+    except FileNotFoundError:
+        return
+    if S_ISLNK(target_stat.st_mode) or target_stat.st_nlink > 1:
+        os.remove(target)
+
+
+def _checkpoints(progress, checkpoint, fdst, offset):
+    """Wrap progress callback to call checkpoint every CHECKPOINT bytes.
+
+    checkpoint gets called with the number of bytes of the target which have
+    been synced to disk.
+    """
+    position = offset
+    synced = offset
+
+    def report(nbytes):
+        nonlocal position, synced
+        progress(nbytes)
+        position += nbytes
+        if position - synced >= CHECKPOINT:
+            fdst.flush()
+            os.fsync(fdst.fileno())
+            synced = position
+            checkpoint(synced)
+
+    return report
+
+
+def copy_file(source, target, progress=_ignore_progress, offset=0,
+              checkpoint=None, hasher=None):
+    """Copy content of source to target.
+
+    progress gets called with the number of bytes copied whenever a chunk has
+    been written. If offset is given, the first offset bytes of target are
+    kept and copying resumes from there. checkpoint, if given, is called
+    every now and then with the number of bytes safely on disk, see
+    _checkpoints. Returns the name of the backend which did the copying.
+
+    hasher, a hashlib-like object, gets fed the content of target. Data then
+    has to pass through userspace, so only read/write is used, but it's read
+    just once for copying and hashing.
+    """
+    _make_way(target)
+    if offset and not path.isfile(target):
+        offset = 0
+    with open(source, 'rb') as fsrc, \
+            open(target, 'r+b' if offset else 'wb') as fdst:
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+        size = os.fstat(infd).st_size
+        large = size >= LARGE_FILE
+        if large and hasattr(os, 'posix_fadvise'):
+            # doubles the read-ahead window on Linux
+            os.posix_fadvise(infd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        backends = BACKENDS if hasher is None else []
+        if offset:
+            fdst.truncate(offset)
+            if hasher is not None:
+                fdst.seek(0)
+                for block in iter(lambda: fdst.read(BLOCKSIZE), b''):
+                    hasher.update(block)
+            fdst.seek(offset)
+            fsrc.seek(offset)
+            # clones can't be appended to a partial copy
+            backends = [(name, backend) for name, backend in backends
+                        if name != 'reflink']
+        if checkpoint:
+            progress = _checkpoints(progress, checkpoint, fdst, offset)
+        for name, backend in backends:
+            try:
+                backend(infd, outfd, size, progress)
+            except Unsupported:
+                continue
+            return name
+        _read_write(fsrc, fdst, progress, CHUNKSIZE if large else BLOCKSIZE,
+                    hasher)
+        return 'read/write'
+
+
+MODES = ['copy', 'hardlink', 'symlink', 'reflink', 'auto']
+# modes which don't take up space for file content at the destination
+LINK_MODES = ['hardlink', 'symlink', 'reflink']
+
+# errors meaning a file system doesn't support hard links
+NO_HARDLINKS = UNSUPPORTED | {errno.EPERM, errno.EMLINK}
+
+
+def _remove(target):
+    """Make way for a link at target."""
+    try:
+        os.remove(target)
+    except FileNotFoundError:
+        pass
+
+
+def _hardlink(source, target):
+    """Hard link target to source."""
+    _remove(target)
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno in NO_HARDLINKS:
+            raise Unsupported(e)
+        raise
+
+
+def _symlink(source, target):
+    """Symlink target to source."""
+    # a dangling link would happily be created for missing files
+    os.stat(source)
+    _remove(target)
+    os.symlink(path.abspath(source), target)
+
+
+def _reflink_file(source, target, progress):
+    """Clone source into target."""
+    _make_way(target)
+    with open(source, 'rb') as fsrc, open(target, 'wb') as fdst:
+        infd = fsrc.fileno()
+        _reflink(infd, fdst.fileno(), os.fstat(infd).st_size, progress)
+
+
+def clone_file(source, target, progress=_ignore_progress, hasher=None):
+    """Reflink or, failing that, hard link target to source.
+
+    Raises Unsupported if neither works. Returns the name of the backend.
+    hasher gets fed the content of source, see copy_file.
+    """
+    try:
+        _reflink_file(source, target, progress)
+        backend = 'reflink'
+    except Unsupported:
+        _hardlink(source, target)
+        progress(os.stat(target).st_size)
+        backend = 'hardlink'
+    if hasher is not None:
+        update_from(source, hasher)
+    return backend
+
+
+def export_file(source, target, mode='copy', progress=_ignore_progress,
+                offset=0, checkpoint=None, hasher=None):
+    """Put source at target according to mode.
+
+    `auto` hard links the file if possible and copies it otherwise, e.g.
+    across devices. The other modes raise Unsupported if the file system
+    can't handle them. Links count as copying the whole file for progress.
+    offset, checkpoint and hasher are passed on to copy_file for copies;
+    for links, hasher is fed the content of source. Returns the name of the
+    backend used.
+    """
+    if mode == 'copy':
+        return copy_file(source, target, progress, offset, checkpoint,
+                         hasher)
+    elif mode == 'hardlink':
+        _hardlink(source, target)
+    elif mode == 'symlink':
+        _symlink(source, target)
+    elif mode == 'reflink':
+        _reflink_file(source, target, progress)
+        if hasher is not None:
+            update_from(source, hasher)
+        return mode
+    elif mode == 'auto':
+        try:
+            _hardlink(source, target)
+        except Unsupported:
+            return copy_file(source, target, progress, offset, checkpoint,
+                             hasher)
+        mode = 'hardlink'
+    else:
+        raise ValueError("unknown mode: {0}".format(mode))
+    progress(os.stat(target).st_size)
+    if hasher is not None:
+        update_from(source, hasher)
+    return mode
@@ -0,0 +1,109 @@
+"""Atomic and durable placement of copied files."""
+
+import os
+from os import path
+from threading import Lock
+
+
+DURABILITY = ['none', 'file', 'batch']
+
+# a batch gets synced once it holds this many files or bytes
+BATCH_FILES = 100
+BATCH_BYTES = 256 << 20
+
+PART_SUFFIX = '.part'
+
+
+def temp_name(target):
+    """Return name under which target is written until it's complete."""
+    directory, name = path.split(target)
+    return path.join(directory, '.' + name + PART_SUFFIX)
+
+
+def is_temp_name(name):
+    """Check if name is the name of an incomplete target."""
+    return name.startswith('.') and name.endswith(PART_SUFFIX)
+
+
+def _fsync(filename):
+    """Flush data of file or directory to disk."""
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _replace(temp, target):
+    """Atomically move temp to target."""
+    os.replace(temp, target)
+    if path.lexists(temp):
+        # replacing a hard link with another link to the same file does
+        # nothing at all
+        os.remove(temp)
+
+
+class Committer:
+
+    """Move complete files from their temporary names to their targets.
+
+    Targets never show up before their content is complete. How much of
+    that survives a crash depends on `durability`:
+
+    none: files are renamed right away, leaving it to the operating system
+        when data and directory entries hit the disk.
+    file: each file is synced before and its directory after renaming it.
+    batch: files are renamed in batches of BATCH_FILES files or BATCH_BYTES
+        bytes, syncing the data of the whole batch first and the directory
+        afterwards. Until then they keep their temporary names, so a crash
+        can't leave targets with missing data behind.
+    """
+
+    def __init__(self, directory, durability='none'):
+        """Initialisation."""
+        if durability not in DURABILITY:
+            raise ValueError("unknown durability: {0}".format(durability))
+        self.directory = directory
+        self.durability = durability
+        self._pending = []
+        self._bytes = 0
+        self._lock = Lock()
+
+    def commit(self, temp, target, size, done, data=True):
+        """Move temp to target and call done once it's there.
+
+        data is False for links, which have no data of their own to sync.
+        """
+        if self.durability == 'none':
+            _replace(temp, target)
+            done()
+        elif self.durability == 'file':
+            if data:
+                _fsync(temp)
+            _replace(temp, target)
+            _fsync(self.directory)
+            done()
+        else:
+            with self._lock:
+                self._pending.append((temp, target, done, data))
+                self._bytes += size
+                full = (len(self._pending) >= BATCH_FILES or
+                        self._bytes >= BATCH_BYTES)
+            if full:
+                self.flush()
+
+    def flush(self):
+        """Commit all files of the current batch."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._bytes = 0
+        if not pending:
+            return
+        for temp, target, done, data in pending:
+            if data:
+                _fsync(temp)
+        for temp, target, done, data in pending:
+            _replace(temp, target)
+        _fsync(self.directory)
+        for temp, target, done, data in pending:
+            done()
@@ -0,0 +1,90 @@
+"""Journal of copy jobs, so interrupted jobs can be resumed."""
+
+import json
+from os import path, remove
+from threading import Lock
+
+
+JOURNAL = '.squarepig-journal'
+
+
+class Journal:
+
+    """Append-only record of the progress of a copy job.
+
+    The journal lives in the destination directory, so it travels with the
+    files it describes. Each line is a JSON list of an entry type, the index
+    of the file in the playlist, a size and the source path: 'done' entries
+    record the size of a finished target, 'part' entries how many bytes of a
+    target have been written and synced to disk so far.
+    """
+
+    def __init__(self, destination, resume=False):
+        """Open journal, loading previous entries if resume is set."""
+        self.filename = path.join(destination, JOURNAL)
+        self.done = {}
+        self.partial = {}
+        if resume:
+            self._load()
+        self._lock = Lock()
+        # line buffered, so every entry is written out immediately
+        self._file = open(self.filename, 'a' if resume else 'w',
+                          encoding='utf-8', buffering=1)
+
+    def _load(self):
+        """Read entries of a previous job."""
+        try:
+            ofile = open(self.filename, encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with ofile:
+            for line in ofile:
+                try:
+                    kind, index, size, source = json.loads(line)
+                except ValueError:
+                    # torn write at the end of an interrupted job
+                    continue
+                if kind == 'done':
+                    self.done[index] = (size, source)
+                    self.partial.pop(index, None)
+                elif kind == 'part':
+                    self.partial[index] = (size, source)
+
+    def _write(self, kind, index, size, source):
+        line = json.dumps([kind, index, size, source])
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def finished(self, index, source):
+        """Return size of target if source has been finished before."""
+        size, done_source = self.done.get(index, (None, None))
+        if done_source == source:
+            return size
+        return None
+
+    def offset(self, index, source):
+        """Return number of bytes of source which are safely at its target."""
+        size, partial_source = self.partial.get(index, (0, None))
+        if partial_source == source:
+            return size
+        return 0
+
+    def record_done(self, index, size, source):
+        """Record that source has been copied completely."""
+        self._write('done', index, size, source)
+
+    def record_partial(self, index, size, source):
+        """Record that the first size bytes of source have been synced."""
+        self._write('part', index, size, source)
+
+    def close(self):
+        """Close journal."""
+        self._file.close()
+
+    def remove(self):
+        """Close and delete journal once a job has been finished."""
+        self.close()
+        try:
+            remove(self.filename)
+        except FileNotFoundError:
+            pass
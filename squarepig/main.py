@@ -3,94 +3,417 @@
 """Squarepig."""
 
 import argparse
-import gettext
-from imp import find_module
+from datetime import timedelta
 from os import path
 from sys import stderr
+from threading import Event, Thread
 
 from squarepig import __version__
-from squarepig.backpig import SquarePig, Playlist
+from squarepig.checksums import ALGORITHMS, new_hash
+from squarepig.copyfile import MODES
+from squarepig.durable import DURABILITY
+from squarepig.writers import ARCHIVE_FORMATS
 
+# Everything else - the copy engine, the GUI and its translations - is
+# imported only once it's needed, which keeps the CLI quick to start.
 
-GUI = True
+MB = 1000 ** 2
 
-try:
-    # check if PyQt is installed
-    find_module('PyQt4')
-except ImportError:
-    GUI = False
 
+class StatusLine(Thread):
 
-gettext.install('squarepig', '/usr/share/locale')
+    """Periodically write progress of a copy job to stderr."""
+
+    def __init__(self, sargasso, interval=1.0):
+        """Initialise thread."""
+        Thread.__init__(self, daemon=True)
+        self.sargasso = sargasso
+        self.interval = interval
+        self.done = Event()
+        # overwrite the line in place on terminals
+        self.end = "\r" if stderr.isatty() else "\n"
+        self.width = 0
+
+    def _write(self, line, end):
+        stderr.write(line.ljust(self.width) + end)
+        stderr.flush()
+        self.width = len(line) if end == "\r" else 0
+
+    def _status(self):
+        index, length = self.sargasso.get_progress()
+        stats = self.sargasso.get_stats()
+        if stats['eta'] is None:
+            eta = "--:--:--"
+        else:
+            eta = str(timedelta(seconds=int(stats['eta'])))
+        return (
+            "{index}/{length} files, {copied:.1f}/{total:.1f} MB, "
+            "{rate:.1f} MB/s (avg {average:.1f} MB/s), ETA {eta}".format(
+                index=index, length=length,
+                copied=stats['copied_bytes'] / MB,
+                total=stats['total_bytes'] / MB,
+                rate=stats['rate'] / MB, average=stats['average_rate'] / MB,
+                eta=eta))
+
+    def run(self):
+        """Run thread."""
+        while not self.done.wait(self.interval):
+            self._write(self._status(), self.end)
+
+    def stop(self):
+        """Stop thread."""
+        self.done.set()
+        self.join()
+        if self.width:
+            self._write("", "\r")
+
+    def summary(self):
+        """Write summary of the finished job."""
+        stats = self.sargasso.get_stats()
+        elapsed = stats['elapsed']
+        self._write(
+            "copied {copied:.1f} MB in {elapsed:.1f}s ({rate:.1f} MB/s)"
+            .format(copied=stats['copied_bytes'] / MB, elapsed=elapsed,
+                    rate=stats['copied_bytes'] / MB / elapsed
+                    if elapsed else 0),
+            "\n")
+
+
+def gui_available():
+    """Check if PyQt is installed without importing it."""
+    from importlib.util import find_spec
+    return find_spec('PyQt4') is not None
 
 
 def gui():
     """Start GUI."""
+    import gettext
+    gettext.install('squarepig', '/usr/share/locale')
     from squarepig.qtpig import main as gui_main
     gui_main()
 
 
+def read_manifest(filename):
+    """Read list of (playlist, destination) pairs from batch manifest.
+
+    Each line holds a playlist and a destination separated by a tab; empty
+    lines and lines starting with '#' are ignored.
+    """
+    jobs = []
+    with open(path.expanduser(filename), encoding='utf-8') as ofile:
+        for number, line in enumerate(ofile, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) != 2:
+                raise ValueError(
+                    "line {0}: expected PLAYLIST<tab>DESTINATION".format(
+                        number))
+            jobs.append((fields[0], fields[1]))
+    return jobs
+
+
+def playlist_cache(args):
+    """Return cache of parsed playlists, unless it's disabled or unusable."""
+    if args.no_cache:
+        return None
+    from squarepig.cache import PlaylistCache
+    try:
+        return PlaylistCache()
+    except OSError:
+        return None
+
+
+def copy(parser, args, playlist, destination, musicdir, options):
+    """Copy files of a single playlist."""
+    from squarepig.backpig import SquarePig, Playlist
+    sargasso = SquarePig()
+    try:
+        playlist = Playlist(playlist, musicdir, playlist_cache(args))
+    except Playlist.UnknownPlaylistFormat:
+        parser.error("unknown playlist format")
+    except Playlist.UnsupportedPlaylistFormat as e:
+        parser.error("unsupported playlist format: {0}\n".format(e))
+    except FileNotFoundError:
+        parser.error("unable to find '{0}'\n".format(playlist))
+    status = None
+    if not args.quiet:
+        status = StatusLine(sargasso)
+        status.start()
+    try:
+        sargasso.copy_to(playlist.iter_files(), destination, jobs=args.jobs,
+                         **options)
+    except SquarePig.CopyError as e:
+        stderr.write(str(e) + "\n")
+        exit(1)
+    except Playlist.UnsupportedPlaylistFormat as e:
+        parser.error("unsupported playlist format: {0}\n".format(e))
+    finally:
+        if status:
+            status.stop()
+    if status:
+        status.summary()
+    if args.verbose:
+        backends = sargasso.get_backends()
+        for index in sorted(backends):
+            print("{0}: {1}".format(index, backends[index]))
+
+
+def copy_batch(args, jobs, musicdir, options):
+    """Copy files of several playlists on a shared pool of workers."""
+    from squarepig.backpig import Playlist
+    from squarepig.batch import Batch
+    batch = Batch(args.jobs, **options)
+    # name of each job and its index in batch or why it can't be run
+    reports = []
+    cache = playlist_cache(args)
+    for playlist, destination in jobs:
+        name = "{0} -> {1}".format(playlist, destination)
+        try:
+            files = Playlist(playlist, musicdir, cache).get_files()
+        except Playlist.UnknownPlaylistFormat:
+            reports.append((name, "unknown playlist format"))
+        except Playlist.UnsupportedPlaylistFormat as e:
+            reports.append((name, "unsupported playlist format: {0}".format(
+                e)))
+        except (OSError, UnicodeDecodeError) as e:
+            reports.append((name, "unable to read playlist: {0}".format(e)))
+        else:
+            reports.append((name, len(batch.sargassos)))
+            batch.add(files, destination)
+    status = None
+    if not args.quiet:
+        status = StatusLine(batch)
+        status.start()
+    try:
+        batch.run()
+    finally:
+        if status:
+            status.stop()
+    errors = 0
+    totals = [0, 0, 0]
+    for name, job in reports:
+        if job in batch.errors:
+            job = batch.errors[job]
+        if not isinstance(job, int):
+            errors += 1
+            print("{0}: {1}".format(name, job))
+            continue
+        sargasso = batch.sargassos[job]
+        counts = [len(sargasso.get_backends()), len(sargasso.get_skipped()),
+                  len(sargasso.get_failed())]
+        totals = [total + count for total, count in zip(totals, counts)]
+        print("{0}: {1} copied, {2} skipped, {3} failed".format(name,
+                                                                *counts))
+    print(
+        "{0} playlists, {1} failed: {2} copied, {3} skipped, {4} failed"
+        .format(len(reports), errors, *totals))
+    if status:
+        status.summary()
+    if errors:
+        exit(1)
+
+
+def verify(args, destinations):
+    """Check destinations against their manifests.
+
+    Returns whether all of them are intact.
+    """
+    from squarepig.backpig import SquarePig
+    intact = True
+    for destination in destinations:
+        sargasso = SquarePig()
+        status = None
+        if not args.quiet:
+            status = StatusLine(sargasso)
+            status.start()
+        try:
+            sargasso.verify(destination, jobs=args.jobs)
+        except SquarePig.CopyError as e:
+            stderr.write(str(e) + "\n")
+            intact = False
+            continue
+        finally:
+            if status:
+                status.stop()
+        if sargasso.get_failed():
+            intact = False
+    return intact
+
+
 def main():
     """Run Squarepig."""
     parser = argparse.ArgumentParser(prog='squarepig')
     parser.add_argument(
-        '-p', '--playlist', metavar='PLAYLIST', type=str,
-        help='playlist file - supported formats: [ m3u, xspf ]')
+        '-p', '--playlist', metavar='PLAYLIST', type=str, action='append',
+        help='playlist file - supported formats: [ m3u, xspf ]; may be '
+             'repeated along with --destination')
     parser.add_argument(
         '-d', '--destination', metavar='DESTINATION', type=str,
-        help='target directory')
+        action='append',
+        help='target directory or sftp://, dav:// or davs:// URL')
+    parser.add_argument(
+        '-a', '--archive', metavar='FILE', type=str,
+        help='stream files of PLAYLIST into a tar or zip archive instead of '
+             'a directory; - writes it to stdout')
+    parser.add_argument(
+        '--archive-format', choices=ARCHIVE_FORMATS,
+        help='format of the archive (default: guessed from FILE, tar for '
+             'stdout)')
+    parser.add_argument(
+        '-b', '--batch', metavar='MANIFEST', type=str,
+        help='copy each PLAYLIST<tab>DESTINATION pair listed in MANIFEST')
     parser.add_argument(
         '-m', '--musicdir', metavar='MUSIC_DIR', type=str,
         help='prefix paths in playlist with MUSIC_DIR')
+    parser.add_argument(
+        '-j', '--jobs', metavar='N', type=int, default=1,
+        help='number of files to copy concurrently (default: 1)')
+    parser.add_argument(
+        '--preflight', action='store_true',
+        help='check all files and free space in DESTINATION before copying '
+             'anything')
+    parser.add_argument(
+        '-r', '--resume', action='store_true',
+        help='continue an interrupted copy job to DESTINATION')
+    parser.add_argument(
+        '--mode', choices=MODES, default='copy',
+        help='copy files or link them to their source; auto links where '
+             'possible (default: copy)')
+    parser.add_argument(
+        '--durability', choices=DURABILITY, default='none',
+        help='sync nothing, each file or batches of files to disk before '
+             'they show up under their final names (default: none)')
+    parser.add_argument(
+        '-t', '--transcode', metavar='RULE', action='append',
+        help='encode files with the given extensions, e.g. '
+             'flac,wav=opus:96k; profiles: mp3, opus (ffmpeg), lame; may be '
+             'repeated')
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='link files to identical ones exported before instead of '
+             'copying them again')
+    parser.add_argument(
+        '--checksums', choices=ALGORITHMS,
+        help='hash files while copying them and write a manifest such as '
+             'SHA256SUMS to DESTINATION; xxh64 needs the xxhash library')
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='check files in DESTINATION against their manifest, after '
+             'copying if PLAYLIST is given')
+    parser.add_argument(
+        '-s', '--sync', action='store_true',
+        help='skip files which are already up to date in DESTINATION')
+    parser.add_argument(
+        '-c', '--checksum', action='store_true',
+        help='compare file content instead of modification time when syncing')
+    parser.add_argument(
+        '--delete', action='store_true',
+        help='delete numbered files not in PLAYLIST from DESTINATION when '
+             'syncing')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="don't keep parsed playlists in the cache directory")
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help="don't report progress while copying")
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='list how each file was copied')
     parser.add_argument(
         '-V', '--version', action='version',
         version='Squarepig {version}'.format(version=__version__))
     args = parser.parse_args()
 
-    # TODO: Check if this initialisation still makes sense
     musicdir = None
-    playlist = None
-
-    # count number of supplied arguments since argparse doesn't seem to
-    # implement any convenience function for this
-    arg_count = 0
-    pl_and_dest = 0
-    if args.destination:
-        arg_count += 1
-        if path.isfile(path.expanduser(args.destination)):
-            parser.error("DESTINATION {0} is a file.".format(args.destination))
-        pl_and_dest += 1
-    if args.playlist:
-        arg_count += 1
-        playlist = args.playlist
-        pl_and_dest += 1
-    if pl_and_dest % 2 is not 0:
-        parser.error(
-            "destination and playlist arguments are mutually inclusive")
     if args.musicdir:
-        arg_count += 1
         musicdir = path.expanduser(args.musicdir)
-
-    if arg_count == 0:
-        if GUI:
-            gui()
-        else:
-            parser.print_help()
-    else:
-        sargasso = SquarePig()
+    playlists = args.playlist or []
+    destinations = args.destination or []
+    if args.verify and destinations and not playlists and not args.batch:
+        if not verify(args, destinations):
+            exit(1)
+        return
+    if args.archive:
+        if args.destination or args.batch or len(playlists) != 1:
+            parser.error("--archive takes a single PLAYLIST and no "
+                         "DESTINATION")
+        if args.archive == '-' and args.verbose:
+            parser.error("--verbose can't be used while writing the archive "
+                         "to stdout")
+        if args.verify:
+            parser.error("--verify can't be used with --archive")
+        from squarepig.writers import ArchiveWriter
         try:
-            playlist = Playlist(playlist, musicdir)
-        except Playlist.UnknownPlaylistFormat:
-            parser.error("unknown playlist format")
-        except Playlist.UnsupportedPlaylistFormat as e:
-            parser.error("unsupported playlist format: {0}\n".format(e))
-        except FileNotFoundError:
-            parser.error("unable to find '{0}'\n".format(playlist))
+            destinations = [ArchiveWriter(args.archive, args.archive_format,
+                                          args.checksums or 'sha256')]
+        except ValueError as e:
+            parser.error(str(e))
+    if len(playlists) != len(destinations):
+        parser.error(
+            "destination and playlist arguments are mutually inclusive")
+    jobs = list(zip(playlists, destinations))
+    if args.batch:
         try:
-            sargasso.copy_to(playlist.get_files(), args.destination)
-        except SquarePig.CopyError as e:
-            stderr.write(str(e) + "\n")
+            jobs.extend(read_manifest(args.batch))
+        except (OSError, ValueError) as e:
+            parser.error("unable to read batch manifest: {0}".format(e))
+    for playlist, destination in jobs:
+        if (isinstance(destination, str) and
+                path.isfile(path.expanduser(destination))):
+            parser.error("DESTINATION {0} is a file.".format(destination))
+    if args.jobs < 1:
+        parser.error("number of jobs must be at least 1")
+    if (args.checksum or args.delete) and not args.sync:
+        parser.error("--checksum and --delete require --sync")
+    options = {
+        'sync': args.sync,
+        'checksum': args.checksum,
+        'delete': args.delete,
+        'mode': args.mode,
+        'preflight': args.preflight,
+        'resume': args.resume,
+        'durability': args.durability,
+    }
+    if not args.archive and (args.checksums or args.verify):
+        # verifying needs a manifest
+        options['checksums'] = args.checksums or 'sha256'
+        try:
+            new_hash(options['checksums'])
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.dedup:
+        from squarepig.cache import ContentIndex
+        options['content_index'] = ContentIndex()
+    if args.transcode:
+        from squarepig.transcode import parse_rule, Transcoder
+        try:
+            options['transcoder'] = Transcoder(
+                [parse_rule(rule) for rule in args.transcode],
+                content_index=options.get('content_index'))
+        except (ValueError, Transcoder.Error) as e:
+            parser.error("invalid transcode rule: {0}".format(e))
+
+    try:
+        if not jobs:
+            if gui_available():
+                gui()
+            else:
+                parser.print_help()
+        elif len(jobs) == 1:
+            playlist, destination = jobs[0]
+            copy(parser, args, playlist, destination, musicdir, options)
+        else:
+            copy_batch(args, jobs, musicdir, options)
+        if (jobs and args.verify and
+                not verify(args, [destination for playlist, destination
+                                  in jobs])):
             exit(1)
+    finally:
+        if args.dedup:
+            options['content_index'].close()
 
 
 if __name__ == "__main__":
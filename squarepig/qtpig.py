@@ -1,13 +1,24 @@
 """Qt GUI for Squarepig."""
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from sys import argv, exit, stderr
-from os import path, mkdir
-from time import sleep
+from os import path
+from time import monotonic
 
-from xdg.BaseDirectory import xdg_cache_home
 from PyQt4 import QtCore, QtGui
 
-from squarepig.backpig import SquarePig, Playlist
+from squarepig.backpig import (
+    SquarePig, Playlist, PathList, PLAN_BATCH, PLAN_JOBS, _inspect)
+from squarepig.cache import cache_dir, PlaylistCache
+from squarepig.copyfile import MODES
+
+
+# minimum time between two repaints of the playlist during copying in ms
+UPDATE_INTERVAL = 100
+
+# maximum number of entries added to the playlist view at once while loading
+LOAD_CHUNK = 5000
 
 
 class SquarepigThread(QtCore.QThread):
@@ -15,61 +26,197 @@ class SquarepigThread(QtCore.QThread):
     """Worker thread."""
 
     error = QtCore.pyqtSignal(object)
+    # progress events of SquarePig, see SquarePig.add_listener
+    event = QtCore.pyqtSignal(object, object)
 
-    def __init__(self, files, destination):
+    def __init__(self, files, destination, mode='copy'):
         """Initialise thread."""
         # XXX: DEBUG output
         print("initialising squarepig thread...")
         QtCore.QThread.__init__(self)
         self.sargasso = SquarePig()
+        # signals are queued across threads, so it's safe to emit them from
+        # SquarePig's worker threads
+        self.sargasso.add_listener(self.event.emit)
         self.files = files
         self.destination = destination
+        self.mode = mode
 
     def run(self):
         """Run thread."""
         # XXX: DEBUG output
         print("run squarepig thread")
         try:
-            self.sargasso.copy_to(self.files, self.destination)
+            self.sargasso.copy_to(self.files, self.destination,
+                                  mode=self.mode)
         except SquarePig.CopyError as e:
             self.error.emit(e)
 
 
-class ProgressThread(QtCore.QThread):
+class PlaylistLoader(QtCore.QThread):
 
-    """Progress update thread."""
+    """Parse a playlist and check its files off the UI thread.
 
-    progress = QtCore.pyqtSignal(object, object)
-    state = QtCore.pyqtSignal(object)
+    Entries are passed on in chunks while parsing goes on, so the view
+    fills up right away. Files are checked by a pool of threads in the
+    meantime, since that's slow on network shares.
+    """
+
+    # lists of entries
+    chunk = QtCore.pyqtSignal(object)
+    # all entries have been passed on
+    parsed = QtCore.pyqtSignal()
+    # lists of (row, problem) pairs for files which can't be copied
+    problems = QtCore.pyqtSignal(object)
+    error = QtCore.pyqtSignal(object)
 
-    def __init__(self, sargasso):
+    def __init__(self, filename, cache=None):
         """Initialise thread."""
-        # XXX: DEBUG output
-        print("initialising progress thread...")
         QtCore.QThread.__init__(self)
-        self.sargasso = sargasso
+        self.filename = filename
+        self.cache = cache
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop loading as soon as possible."""
+        self.cancelled = True
 
     def run(self):
         """Run thread."""
-        # XXX: DEBUG output
-        print("run progress thread")
-        self.length = -1
-        while True:
-            state = self.sargasso.get_state()
-            self.state.emit(state)
-            if state not in ['stopped', 'done']:
-                index, self.length = self.sargasso.get_progress()
-                failed = self.sargasso.get_failed()
-                self.progress.emit(index, failed)
-            else:
-                index, self.length = self.sargasso.get_progress()
-                failed = self.sargasso.get_failed()
-                # XXX: DEBUG output
-                print("failed: %s" % str(failed))
-                self.progress.emit(index, failed)
-                self.state.emit(state)
-                break
-            sleep(0.2)
+        try:
+            with ThreadPoolExecutor(max_workers=PLAN_JOBS) as executor:
+                try:
+                    self._load(executor)
+                finally:
+                    executor.shutdown(wait=False, cancel_futures=True)
+        except Playlist.UnknownPlaylistFormat:
+            self.error.emit(_("Unknown playlist format"))
+        except Playlist.UnsupportedPlaylistFormat as e:
+            self.error.emit(_("Unsupported playlist format: {0}".format(e)))
+        except (OSError, UnicodeDecodeError):
+            self.error.emit(_("Unable to read playlist: {0}".format(
+                self.filename)))
+
+    def _load(self, executor):
+        checks = []
+        pending = []
+        rows = 0
+        last = monotonic()
+        for file in Playlist(self.filename, cache=self.cache).iter_files():
+            if self.cancelled:
+                return
+            pending.append(file)
+            if (len(pending) >= LOAD_CHUNK or
+                    monotonic() - last >= UPDATE_INTERVAL / 1000):
+                checks.extend(self._emit(executor, pending, rows))
+                rows += len(pending)
+                pending = []
+                last = monotonic()
+        checks.extend(self._emit(executor, pending, rows))
+        self.parsed.emit()
+        for first, check in checks:
+            if self.cancelled:
+                return
+            problems = [(first + offset, problem) for offset, (
+                size, device, problem) in enumerate(check.result()) if problem]
+            if problems:
+                self.problems.emit(problems)
+
+    def _emit(self, executor, files, first):
+        """Pass on files and return (first row, future) pairs checking them."""
+        if not files:
+            return []
+        self.chunk.emit(files)
+        return [(first + i, executor.submit(_inspect, files[i:i + PLAN_BATCH]))
+                for i in range(0, len(files), PLAN_BATCH)]
+
+
+class PlaylistModel(QtCore.QAbstractListModel):
+
+    """Files of a playlist along with the status of each of them.
+
+    Rows are only put together when the view asks for them, so even huge
+    playlists cost little more than their PathList.
+    """
+
+    PENDING, COPIED, FAILED, MISSING = range(4)
+
+    COLORS = {
+        COPIED: QtGui.QColor(198, 233, 175),
+        FAILED: QtGui.QColor(211, 95, 95),
+        MISSING: QtGui.QColor(233, 198, 175),
+    }
+
+    # turns copied and failed rows back into pending ones, see reset_status
+    RESET = bytes(MISSING if status == MISSING else PENDING
+                  for status in range(256))
+
+    def __init__(self, parent=None):
+        """Initialise model."""
+        super(PlaylistModel, self).__init__(parent)
+        self.files = PathList()
+        # one status byte per row
+        self.status = bytearray()
+        # row -> why the file can't be copied
+        self.problems = {}
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.files)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == QtCore.Qt.DisplayRole:
+            return self.files[row]
+        elif role == QtCore.Qt.BackgroundRole:
+            color = self.COLORS.get(self.status[row])
+            if color is not None:
+                return QtGui.QBrush(color)
+        elif role == QtCore.Qt.ToolTipRole:
+            return self.problems.get(row)
+        return None
+
+    def set_files(self, files):
+        """Show files, all of them pending."""
+        self.beginResetModel()
+        self.files = files
+        self.status = bytearray(len(files))
+        self.problems = {}
+        self.endResetModel()
+
+    def append_files(self, files):
+        """Add files at the end."""
+        first = len(self.files)
+        self.beginInsertRows(QtCore.QModelIndex(), first,
+                             first + len(files) - 1)
+        for file in files:
+            self.files.append(file)
+        self.status.extend(bytes(len(files)))
+        self.endInsertRows()
+
+    def set_problems(self, problems):
+        """Mark files which can't be copied, see PlaylistLoader."""
+        self.problems.update(problems)
+        self.set_status([row for row, problem in problems], self.MISSING)
+
+    def set_status(self, rows, status):
+        """Set status of rows."""
+        if not rows:
+            return
+        for row in rows:
+            self.status[row] = status
+        # a single signal for the span of rows keeps repaints cheap
+        self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)))
+
+    def reset_status(self):
+        """Mark all rows as pending again, keeping missing files marked."""
+        self.status = self.status.translate(self.RESET)
+        if self.files:
+            self.dataChanged.emit(self.index(0),
+                                  self.index(len(self.files) - 1))
 
 
 class MyMainWindow(QtGui.QMainWindow):
@@ -126,7 +273,25 @@ class MainWidget(QtGui.QWidget):
         self.main_window = main_window
         self.running = False
 
-        self.qlist = QtGui.QListWidget(self)
+        # rows which changed since the list was last repainted
+        self.copiedRows = set()
+        self.failedRows = set()
+        self.progressIndex = 0
+        # repaint at most every UPDATE_INTERVAL ms
+        self.updateTimer = QtCore.QTimer(self)
+        self.updateTimer.setSingleShot(True)
+        self.updateTimer.timeout.connect(self._on_progress_update)
+
+        self.model = PlaylistModel(self)
+        # the loader of the current playlist and all which are still running
+        self.loader = None
+        self.loaders = set()
+        # set until all entries of the playlist are in the model
+        self.loading = False
+        self.qlist = QtGui.QListView(self)
+        # lets the view skip measuring every row of huge playlists
+        self.qlist.setUniformItemSizes(True)
+        self.qlist.setModel(self.model)
 
         startButtonText = _("Start")
         self.startButton = QtGui.QPushButton(startButtonText)
@@ -154,9 +319,26 @@ class MainWidget(QtGui.QWidget):
         saveLabel = QtGui.QLabel(saveLabelText)
         self.savePath = QtGui.QLineEdit()
 
+        modeLabelText = _("Mode:")
+        modeLabel = QtGui.QLabel(modeLabelText)
+        self.modeBox = QtGui.QComboBox()
+        modeTexts = {
+            'copy': _("Copy"),
+            'hardlink': _("Hard link"),
+            'symlink': _("Symbolic link"),
+            'reflink': _("Reflink"),
+            'auto': _("Link if possible"),
+        }
+        for mode in MODES:
+            self.modeBox.addItem(modeTexts[mode])
+        modeTipText = _("How to put files into the destination directory")
+        self.modeBox.setStatusTip(modeTipText)
+
         hbox = QtGui.QHBoxLayout()
         hbox1 = QtGui.QHBoxLayout()
         hbox2 = QtGui.QHBoxLayout()
+        hbox2.addWidget(modeLabel)
+        hbox2.addWidget(self.modeBox)
         hbox2.addStretch(1)
         hbox2.addWidget(self.startButton)
         hbox1.addWidget(openLabel)
@@ -179,40 +361,50 @@ class MainWidget(QtGui.QWidget):
 
         self.setLayout(vbox)
 
-        self.cachedir = '{0}/squarepig'.format(xdg_cache_home)
         try:
-            mkdir(self.cachedir, 0o755)
+            self.cachedir = cache_dir()
         except OSError:
-            # cachedir does already exist
-            pass
+            # reading and writing the cache fails gracefully later on
+            self.cachedir = path.expanduser('~/.cache/squarepig')
+        self.playlistCache = PlaylistCache(
+            path.join(self.cachedir, 'playlists'))
 
     def show_error(self, msg):
         """Display error message."""
         QtGui.QMessageBox.warning(self, "Warning", str(msg))
 
-    def _on_progress_update(self, data, failed):
-        # FIXME: Right now this doesn't get updated anymore as soon as the
-        # thread stops - this results in the progress count actually being
-        # behind by one.
-        # #NOTE: Above FIXME might actually be fixed now.
-        # XXX: DEBUG output
-        print(data)
-        self.main_window.form_widget.qlist.setCurrentRow(data)
-        for i in range(0, data):
-            self.main_window.form_widget.qlist.item(i).setBackground(
-                QtGui.QColor(198, 233, 175))
-        # paint all failed ones red
-        for j in failed:
-            self.main_window.form_widget.qlist.item(j).setBackground(
-                QtGui.QColor(211, 95, 95))
+    def _on_event(self, event, data):
+        if event == 'state':
+            # make sure the list is up to date before reporting the new state
+            self._on_progress_update()
+            self._on_state_update(data)
+            return
+        elif event == 'progress':
+            self.progressIndex = data[0]
+        elif event == 'failed':
+            self.failedRows.add(data)
+        elif event in ['copied', 'skipped']:
+            self.copiedRows.add(data)
+        if not self.updateTimer.isActive():
+            self.updateTimer.start(UPDATE_INTERVAL)
+
+    def _on_progress_update(self):
+        self.updateTimer.stop()
+        # only repaint rows which changed since the last update
+        self.model.set_status(self.copiedRows, PlaylistModel.COPIED)
+        self.model.set_status(self.failedRows, PlaylistModel.FAILED)
+        self.copiedRows.clear()
+        self.failedRows.clear()
+        self.qlist.setCurrentIndex(self.model.index(self.progressIndex))
         if self.sargasso.stop:
             msg = _("Stopping...")
             self.main_window.statusBar().showMessage(msg)
         else:
+            stats = self.sargasso.get_stats()
             self.main_window.statusBar().showMessage(
-                "{index}/{length}".format(
-                    index=data,
-                    length=self.main_window.form_widget.qlist.count()))
+                "{index}/{length} - {rate:.1f} MB/s".format(
+                    index=self.progressIndex, length=self.model.rowCount(),
+                    rate=stats['average_rate'] / 1000 ** 2))
 
     def _on_state_update(self, data):
         if data in ['stopped', 'done']:
@@ -269,23 +461,41 @@ class MainWidget(QtGui.QWidget):
             self._load_playlist(fname)
 
     def _load_playlist(self, playlist_file):
-        try:
-            if playlist_file:
-                self.qlist.clear()
-                playlist = Playlist(playlist_file)
-        except Playlist.UnknownPlaylistFormat:
-            errorText = _("Unknown playlist format")
-            self.show_error(errorText)
-        except Playlist.UnsupportedPlaylistFormat as e:
-            errorText = _("Unsupported playlist format: {0}".format(e))
-            self.show_error(errorText)
-        except (FileNotFoundError, UnicodeDecodeError):
-            errorText = _("Unable to read playlist: {0}".format(playlist_file))
-            self.show_error(errorText)
-        else:
-            files = playlist.get_files()
-            for f in files:
-                self.qlist.addItem(f)
+        if not playlist_file or self.running:
+            return
+        if self.loader is not None:
+            self.loader.cancel()
+        self.model.set_files(PathList())
+        loader = PlaylistLoader(playlist_file, self.playlistCache)
+        loader.chunk.connect(partial(self._on_chunk, loader))
+        loader.parsed.connect(partial(self._on_parsed, loader))
+        loader.problems.connect(partial(self._on_problems, loader))
+        loader.error.connect(partial(self._on_load_error, loader))
+        # threads must not be garbage collected while they're running
+        self.loaders.add(loader)
+        loader.finished.connect(partial(self.loaders.discard, loader))
+        self.loader = loader
+        self.loading = True
+        loader.start()
+
+    # signals a cancelled loader sent before noticing are dropped
+
+    def _on_chunk(self, loader, files):
+        if loader is self.loader:
+            self.model.append_files(files)
+
+    def _on_parsed(self, loader):
+        if loader is self.loader:
+            self.loading = False
+
+    def _on_problems(self, loader, problems):
+        if loader is self.loader:
+            self.model.set_problems(problems)
+
+    def _on_load_error(self, loader, msg):
+        if loader is self.loader:
+            self.loading = False
+            self.show_error(msg)
 
     def _open_destination(self):
         dst_path = '~'
@@ -328,44 +538,31 @@ class MainWidget(QtGui.QWidget):
         if self.running:
             self.sargasso.stop = True
         else:
-            files = []
-
-            for index in range(0, self.qlist.count()):
-                # Clear list style
-                self.main_window.form_widget.qlist.item(index).setBackground(
-                    QtGui.QColor('white'))
-                files.append(self.qlist.item(index).text())
+            if self.loading:
+                errorText = _("Please wait until the playlist is loaded")
+                self.show_error(errorText)
+                return
+            files = self.model.files
+            self.model.reset_status()
             if len(files) == 0:
                 errorText = _("Please select a playlist first")
                 self.show_error(errorText)
                 return
             destination = self.savePath.text()
 
-            self.threads = []
+            mode = MODES[self.modeBox.currentIndex()]
 
-            sargasso = SquarepigThread(files, destination)
-            sargasso.error.connect(self._on_error)
+            self.progressIndex = 0
+            self.copiedRows.clear()
+            self.failedRows.clear()
 
-            self.threads.append(sargasso)
-            # sargasso.start()
+            sargasso = SquarepigThread(files, destination, mode)
+            sargasso.error.connect(self._on_error)
+            sargasso.event.connect(self._on_event)
 
+            self.threads = [sargasso]
             self.sargasso = sargasso.sargasso
-
-            progress = ProgressThread(sargasso.sargasso)
-            progress.state.connect(self._on_state_update)
-            progress.progress.connect(self._on_progress_update)
-
-            self.threads.append(progress)
-            # progress.start()
-            # sleep(0.1)
-            # for t in self.threads:
-            #     t.start()
-
-            # NOTE: Make sure sargasso thread is started before progress
-            # thread, so progress thread has something to report.
             sargasso.start()
-            sleep(0.1)
-            progress.start()
 
 
 def main():
@@ -0,0 +1,189 @@
+"""Transcoding of files on their way to the destination."""
+
+import os
+import subprocess
+from hashlib import sha256
+from os import path
+from shutil import which
+from threading import BoundedSemaphore, get_ident
+
+from squarepig.cache import cache_dir, digest, evict, touch
+
+
+class Profile:
+
+    """Encoder command line producing one kind of target files.
+
+    command is a list of arguments, which may contain the placeholders
+    {source}, {target} and {bitrate}.
+    """
+
+    def __init__(self, name, extension, command, bitrate=None):
+        """Initialisation."""
+        self.name = name
+        self.extension = extension
+        self.command = command
+        self.bitrate = bitrate
+
+    @property
+    def key(self):
+        """Return name identifying encoded files of this profile."""
+        command = sha256('\0'.join(self.command).encode()).hexdigest()[:12]
+        return '{0}-{1}-{2}'.format(self.name, self.bitrate or 'default',
+                                    command)
+
+    def arguments(self, source, target):
+        """Return command line encoding source to target."""
+        return [argument.format(source=source, target=target,
+                                bitrate=self.bitrate)
+                for argument in self.command]
+
+
+FFMPEG = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', '{source}',
+          '-map', '0:a', '-map_metadata', '0']
+
+PROFILES = {
+    'mp3': ('mp3', FFMPEG + ['-codec:a', 'libmp3lame', '-b:a', '{bitrate}',
+                             '-f', 'mp3', '{target}'], '192k'),
+    'opus': ('opus', FFMPEG + ['-codec:a', 'libopus', '-b:a', '{bitrate}',
+                               '-f', 'opus', '{target}'], '128k'),
+    'lame': ('mp3', ['lame', '--quiet', '--preset', 'cbr', '{bitrate}',
+                     '{source}', '{target}'], '192'),
+}
+
+
+def profile(name, bitrate=None):
+    """Return one of the predefined PROFILES."""
+    try:
+        extension, command, default_bitrate = PROFILES[name]
+    except KeyError:
+        raise ValueError("unknown profile: {0}".format(name))
+    return Profile(name, extension, command, bitrate or default_bitrate)
+
+
+def parse_rule(rule):
+    """Parse rule of the form EXTENSIONS=PROFILE[:BITRATE].
+
+    E.g. 'flac,wav=opus:96k' transcodes FLAC and WAV files with the opus
+    profile at 96 kbit/s. Returns a (extensions, Profile) pair.
+    """
+    try:
+        extensions, target = rule.split('=')
+    except ValueError:
+        raise ValueError("expected EXTENSIONS=PROFILE[:BITRATE]: {0}".format(
+            rule))
+    name, _, bitrate = target.partition(':')
+    return ({extension.strip().lower().lstrip('.')
+             for extension in extensions.split(',')},
+            profile(name.strip(), bitrate.strip() or None))
+
+
+class Transcoder:
+
+    """Transcode files according to rules, caching the results.
+
+    rules is a list of (extensions, Profile) pairs; the first rule matching
+    the extension of a file decides how it's encoded, files no rule matches
+    are copied as they are. Encoded files are kept in a cache directory by
+    hash of their source and profile, so exporting them again is just a
+    copy; once they take up more than max_bytes, the least recently used
+    ones are removed. At most `jobs` encoders - by default one per core -
+    run at once.
+    """
+
+    class Error(Exception):
+
+        """Encoding a file failed."""
+
+    def __init__(self, rules, jobs=None, directory=None, content_index=None,
+                 max_bytes=4 << 30):
+        """Initialisation.
+
+        Raises Transcoder.Error if the encoder of a rule isn't installed.
+        content_index, a cache.ContentIndex, saves hashing unchanged
+        sources again.
+        """
+        self.rules = rules
+        self.jobs = jobs or os.cpu_count() or 1
+        if directory is None:
+            directory = path.join(cache_dir(), 'transcoded')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.content_index = content_index
+        self._encoders = BoundedSemaphore(self.jobs)
+        for extensions, rule_profile in rules:
+            if which(rule_profile.command[0]) is None:
+                raise self.Error("encoder not found: {0}".format(
+                    rule_profile.command[0]))
+
+    def profile_for(self, file):
+        """Return Profile for file or None if it's copied as it is."""
+        extension = path.splitext(file)[1].lower().lstrip('.')
+        for extensions, rule_profile in self.rules:
+            if extension in extensions:
+                return rule_profile
+        return None
+
+    def target_name(self, file):
+        """Return file with the extension it gets at the destination."""
+        rule_profile = self.profile_for(file)
+        if rule_profile is None:
+            return file
+        return path.splitext(file)[0] + '.' + rule_profile.extension
+
+    def transcode(self, file):
+        """Return encoded version of file, encoding it if it isn't cached.
+
+        Raises Transcoder.Error if the encoder fails.
+        """
+        rule_profile = self.profile_for(file)
+        if self.content_index is not None:
+            source_digest = self.content_index.digest(file)
+        else:
+            source_digest = digest(file)
+        directory = path.join(self.directory, rule_profile.key)
+        cached = path.join(directory, source_digest + '.' +
+                           rule_profile.extension)
+        try:
+            # keeps the modification time, which sync compares targets with
+            touch(cached)
+            return cached
+        except FileNotFoundError:
+            pass
+        os.makedirs(directory, 0o755, exist_ok=True)
+        # encoders of the same file in other threads get names of their own
+        partial = '{0}.{1}-{2}.part.{3}'.format(
+            cached, os.getpid(), get_ident(), rule_profile.extension)
+        with self._encoders:
+            result = subprocess.run(
+                rule_profile.arguments(file, partial),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            try:
+                os.remove(partial)
+            except FileNotFoundError:
+                pass
+            message = result.stderr.decode(errors='replace').strip()
+            raise self.Error("{0} failed: {1}".format(
+                rule_profile.command[0],
+                message.splitlines()[-1] if message else result.returncode))
+        os.replace(partial, cached)
+        self._evict(cached)
+        return cached
+
+    def _evict(self, keep):
+        """Remove least recently used encoded files above max_bytes.
+
+        keep, the file which has just been encoded, stays in any case.
+        """
+        filenames = []
+        for key in os.listdir(self.directory):
+            directory = path.join(self.directory, key)
+            if not path.isdir(directory):
+                continue
+            filenames.extend(path.join(directory, name)
+                             for name in os.listdir(directory)
+                             if '.part.' not in name)
+        evict([filename for filename in filenames if filename != keep],
+              self.max_bytes - os.stat(keep).st_size)
@@ -0,0 +1,492 @@
+"""Destinations other than local directories, e.g. on media players."""
+
+import os
+import sys
+from base64 import b64encode
+from contextlib import contextmanager
+from io import BytesIO
+from os import path
+from shutil import copyfileobj
+from threading import BoundedSemaphore, Lock
+from time import localtime, time
+from urllib.parse import quote, unquote, urlsplit
+
+from squarepig.checksums import MANIFESTS, _ignore_progress, new_hash
+from squarepig.copyfile import BLOCKSIZE, copy_file
+from squarepig.durable import temp_name
+
+
+ARCHIVE_FORMATS = ['tar', 'tar.gz', 'tar.bz2', 'tar.xz', 'zip']
+
+# zip files can't hold earlier timestamps
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+class _SourceError(Exception):
+
+    """Reading the source failed; carries the OSError."""
+
+
+def _blocks(fsrc):
+    """Yield blocks of fsrc, raising _SourceError if it can't be read.
+
+    Tells errors of the source from those of the destination, which are
+    OSErrors as well.
+    """
+    while True:
+        try:
+            block = fsrc.read(BLOCKSIZE)
+        except OSError as e:
+            raise _SourceError(e)
+        if not block:
+            return
+        yield block
+
+
+class Writer:
+
+    """Destination directory files are written to.
+
+    Writers are used by several threads at once. Each write gets a
+    connection of its own from a pool of up to `connections`, which are
+    kept open for the following writes. Files are written under a temporary
+    name and renamed once complete, like in local directories.
+    """
+
+    class Error(Exception):
+
+        """Writing to the destination failed."""
+
+    def __init__(self, connections=1):
+        """Initialisation."""
+        self.connections = connections
+        self._slots = BoundedSemaphore(connections)
+        self._idle = []
+        self._lock = Lock()
+
+    def __str__(self):
+        return self.location
+
+    def _connect(self):
+        """Return new connection."""
+        return None
+
+    def _disconnect(self, connection):
+        """Close connection."""
+
+    @contextmanager
+    def _connection(self, fresh=False):
+        """Borrow a connection from the pool, a new one if fresh is set."""
+        with self._slots:
+            connection = None
+            if not fresh:
+                with self._lock:
+                    connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                connection = self._connect()
+            try:
+                yield connection
+            except BaseException:
+                # the connection might be in any state now
+                self._disconnect(connection)
+                raise
+            with self._lock:
+                self._idle.append(connection)
+
+    def prepare(self):
+        """Create destination directory if it doesn't exist yet."""
+
+    def write(self, name, source, progress=_ignore_progress):
+        """Write file source to name in the destination directory.
+
+        progress is called with the number of bytes written every now and
+        then. Returns the name of the backend which did the writing. Raises
+        OSError if source can't be read and Writer.Error if the destination
+        can't be written to.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Close all connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._disconnect(connection)
+
+
+class LocalWriter(Writer):
+
+    """Local directory."""
+
+    def __init__(self, directory, connections=1):
+        """Initialisation."""
+        Writer.__init__(self, connections)
+        self.location = self.directory = path.expanduser(directory)
+
+    def prepare(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            raise self.Error(e)
+
+    def write(self, name, source, progress=_ignore_progress):
+        target = path.join(self.directory, name)
+        try:
+            with self._connection():
+                backend = copy_file(source, temp_name(target), progress)
+                os.replace(temp_name(target), target)
+        except OSError as e:
+            if e.filename == source:
+                raise
+            raise self.Error(e)
+        return backend
+
+
+class SFTPWriter(Writer):
+
+    """Directory on a host reachable by SFTP, using paramiko.
+
+    Host keys are checked against the user's known_hosts file.
+    """
+
+    def __init__(self, host, directory, username=None, password=None,
+                 port=22, connections=4):
+        """Initialisation."""
+        try:
+            import paramiko
+        except ImportError:
+            raise self.Error(
+                "SFTP destinations require the 'paramiko' python library.")
+        Writer.__init__(self, connections)
+        self._paramiko = paramiko
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.directory = directory
+        self.location = 'sftp://{0}{1}:{2}{3}'.format(
+            username + '@' if username else '', host, port, directory)
+
+    def _connect(self):
+        client = self._paramiko.SSHClient()
+        client.load_system_host_keys()
+        try:
+            client.connect(self.host, self.port, self.username,
+                           self.password)
+            return client, client.open_sftp()
+        except (OSError, self._paramiko.SSHException) as e:
+            client.close()
+            raise self.Error("unable to connect to {0}: {1}".format(
+                self.host, e))
+
+    def _disconnect(self, connection):
+        client, sftp = connection
+        client.close()
+
+    def prepare(self):
+        with self._connection() as (client, sftp):
+            current = ''
+            for part in self.directory.strip('/').split('/'):
+                current += '/' + part
+                try:
+                    sftp.stat(current)
+                except IOError:
+                    try:
+                        sftp.mkdir(current)
+                    except IOError as e:
+                        raise self.Error("unable to create {0}: {1}".format(
+                            current, e))
+
+    def write(self, name, source, progress=_ignore_progress):
+        target = self.directory.rstrip('/') + '/' + name
+        temp = temp_name(target)
+        with open(source, 'rb') as fsrc:
+            with self._connection() as (client, sftp):
+                try:
+                    with sftp.open(temp, 'wb') as fdst:
+                        # don't wait for each block to be acknowledged
+                        fdst.set_pipelined(True)
+                        for block in _blocks(fsrc):
+                            fdst.write(block)
+                            progress(len(block))
+                    sftp.posix_rename(temp, target)
+                except _SourceError as e:
+                    raise e.args[0]
+                except (IOError, self._paramiko.SSHException) as e:
+                    raise self.Error("unable to write {0}: {1}".format(
+                        target, e))
+        return 'sftp'
+
+
+class WebDAVWriter(Writer):
+
+    """Collection on a WebDAV server, spoken to with http.client."""
+
+    def __init__(self, url, connections=4, timeout=60):
+        """Initialisation.
+
+        url is an http or https URL; credentials in it are sent with basic
+        authentication.
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ['http', 'https']:
+            raise ValueError("not an http(s) URL: {0}".format(url))
+        Writer.__init__(self, connections)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.directory = parts.path.rstrip('/') or ''
+        self.headers = {}
+        if parts.username:
+            credentials = '{0}:{1}'.format(unquote(parts.username),
+                                           unquote(parts.password or ''))
+            self.headers['Authorization'] = 'Basic ' + b64encode(
+                credentials.encode()).decode()
+        self.location = '{0}://{1}{2}{3}'.format(
+            parts.scheme, parts.hostname,
+            ':{0}'.format(parts.port) if parts.port else '', self.directory)
+
+    def _connect(self):
+        from http.client import HTTPConnection, HTTPSConnection
+        connection_class = (HTTPSConnection if self.scheme == 'https'
+                            else HTTPConnection)
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _disconnect(self, connection):
+        connection.close()
+
+    def _url(self, name):
+        return self.directory + '/' + quote(name)
+
+    def _request(self, method, url, expected, headers=None, fsrc=None,
+                 progress=_ignore_progress):
+        """Send request, with the content of fsrc if given, and check status.
+
+        Servers close idle connections whenever they like, so a request
+        failing on a pooled connection before any response arrived is sent
+        once more on a new connection.
+        """
+        from http.client import HTTPException
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        reported = 0
+        for retry in [False, True]:
+            answered = False
+            try:
+                with self._connection(fresh=retry) as connection:
+                    reused = connection.sock is not None
+                    connection.putrequest(method, url)
+                    for header, value in all_headers.items():
+                        connection.putheader(header, value)
+                    if fsrc is None:
+                        connection.endheaders()
+                    else:
+                        fsrc.seek(0)
+                        size = os.fstat(fsrc.fileno()).st_size
+                        connection.putheader('Content-Length', str(size))
+                        connection.endheaders()
+                        # stream the file, never holding more than a block
+                        sent = 0
+                        for block in _blocks(fsrc):
+                            connection.send(block)
+                            sent += len(block)
+                            # don't report blocks sent again on retry
+                            if sent > reported:
+                                progress(sent - reported)
+                                reported = sent
+                    response = connection.getresponse()
+                    answered = True
+                    response.read()
+                break
+            except _SourceError as e:
+                raise e.args[0]
+            except (OSError, HTTPException) as e:
+                if (isinstance(e, ConnectionError) and reused and
+                        not answered and not retry):
+                    continue
+                raise self.Error("{0} {1} failed: {2}".format(
+                    method, url, e))
+        if response.status not in expected:
+            raise self.Error("{0} {1} failed: {2} {3}".format(
+                method, url, response.status, response.reason))
+        return response
+
+    def prepare(self):
+        current = ''
+        for part in self.directory.strip('/').split('/'):
+            if not part:
+                continue
+            current += '/' + part
+            # 405 means the collection exists already
+            self._request('MKCOL', current + '/', [200, 201, 405])
+
+    def write(self, name, source, progress=_ignore_progress):
+        target = self._url(name)
+        temp = self._url('.' + name + '.part')
+        with open(source, 'rb') as fsrc:
+            self._request('PUT', temp, [200, 201, 204], fsrc=fsrc,
+                          progress=progress)
+        destination = '{0}://{1}{2}{3}'.format(
+            self.scheme, self.host,
+            ':{0}'.format(self.port) if self.port else '', target)
+        self._request('MOVE', temp, [201, 204],
+                      {'Destination': destination, 'Overwrite': 'T'})
+        return 'webdav'
+
+
+def archive_format(filename):
+    """Guess one of ARCHIVE_FORMATS from filename, defaulting to tar."""
+    if filename.endswith('.tgz'):
+        return 'tar.gz'
+    for archive in sorted(ARCHIVE_FORMATS, key=len, reverse=True):
+        if filename.endswith('.' + archive):
+            return archive
+    return 'tar'
+
+
+class _HashingReader:
+
+    """File wrapper hashing and reporting data as it's read."""
+
+    def __init__(self, ifile, hasher, progress):
+        """Initialisation."""
+        self.ifile = ifile
+        self.progress = progress
+        self.hash = hasher
+
+    def read(self, size=-1):
+        data = self.ifile.read(size)
+        self.hash.update(data)
+        self.progress(len(data))
+        return data
+
+
+class ArchiveWriter(Writer):
+
+    """Tar or zip archive files are streamed into.
+
+    target is a file name or '-' for stdout; archives are written front to
+    back, so any format can be piped. Sources are read block by block, so
+    memory use doesn't depend on their size. Members are added one at a
+    time, in the order files are done. Their checksums are computed along
+    the way and added as a manifest when the archive is closed.
+    """
+
+    def __init__(self, target, archive=None, algorithm='sha256'):
+        """Initialisation.
+
+        archive is one of ARCHIVE_FORMATS and guessed from target if not
+        given. algorithm is one of checksums.ALGORITHMS and decides the name
+        of the manifest, e.g. SHA256SUMS.
+        """
+        Writer.__init__(self, 1)
+        if archive is None:
+            archive = archive_format(target)
+        if archive not in ARCHIVE_FORMATS:
+            raise ValueError("unknown archive format: {0}".format(archive))
+        new_hash(algorithm)
+        self.target = target
+        self.archive = archive
+        self.algorithm = algorithm
+        self.manifest = MANIFESTS[algorithm]
+        self.location = 'stdout' if target == '-' else target
+        self.checksums = {}
+        self._ofile = None
+        self._archive = None
+
+    def prepare(self):
+        import tarfile
+        import zipfile
+        self.checksums = {}
+        try:
+            if self.target == '-':
+                self._ofile = sys.stdout.buffer
+            else:
+                self._ofile = open(path.expanduser(self.target), 'wb')
+            if self.archive == 'zip':
+                self._archive = zipfile.ZipFile(
+                    self._ofile, 'w', zipfile.ZIP_DEFLATED)
+            else:
+                self._archive = tarfile.open(
+                    fileobj=self._ofile,
+                    mode='w|' + self.archive.partition('.')[2],
+                    copybufsize=BLOCKSIZE)
+        except OSError as e:
+            raise self.Error(e)
+
+    def _add(self, name, ifile, size, mtime):
+        """Add member name with size bytes read from ifile."""
+        if self.archive == 'zip':
+            from zipfile import ZipInfo, ZIP_DEFLATED
+            info = ZipInfo(name, max(localtime(mtime)[:6], ZIP_EPOCH))
+            info.compress_type = ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            # decides whether the member needs zip64 extensions
+            info.file_size = size
+            with self._archive.open(info, 'w') as member:
+                copyfileobj(ifile, member, BLOCKSIZE)
+        else:
+            from tarfile import TarInfo
+            info = TarInfo(name)
+            info.size = size
+            info.mtime = int(mtime)
+            info.mode = 0o644
+            self._archive.addfile(info, ifile)
+
+    def write(self, name, source, progress=_ignore_progress):
+        with open(source, 'rb') as fsrc:
+            source_stat = os.fstat(fsrc.fileno())
+            reader = _HashingReader(fsrc, new_hash(self.algorithm),
+                                    progress)
+            with self._connection():
+                try:
+                    self._add(name, reader, source_stat.st_size,
+                              source_stat.st_mtime)
+                except OSError as e:
+                    raise self.Error("unable to add {0}: {1}".format(
+                        name, e))
+                self.checksums[name] = reader.hash.hexdigest()
+        return self.archive
+
+    def close(self):
+        """Add manifest and finish the archive."""
+        if self._archive is None:
+            return
+        manifest = ''.join(
+            '{0}  {1}\n'.format(self.checksums[name], name)
+            for name in sorted(self.checksums)).encode()
+        try:
+            self._add(self.manifest, BytesIO(manifest), len(manifest),
+                      time())
+            self._archive.close()
+            if self._ofile is sys.stdout.buffer:
+                self._ofile.flush()
+            else:
+                self._ofile.close()
+        except OSError as e:
+            raise self.Error(e)
+        finally:
+            self._archive = None
+
+
+def open_writer(destination, connections=4):
+    """Return Writer for a destination URL or None for local directories.
+
+    Understands sftp://[user[:password]@]host[:port]/path as well as
+    dav:// and davs:// URLs for WebDAV over http and https.
+    """
+    if isinstance(destination, Writer):
+        return destination
+    parts = urlsplit(destination)
+    if parts.scheme == 'sftp':
+        return SFTPWriter(
+            parts.hostname, unquote(parts.path) or '/',
+            unquote(parts.username) if parts.username else None,
+            unquote(parts.password) if parts.password else None,
+            parts.port or 22, connections)
+    elif parts.scheme in ['dav', 'davs']:
+        scheme = 'https' if parts.scheme == 'davs' else 'http'
+        return WebDAVWriter(scheme + destination[len(parts.scheme):],
+                            connections)
+    return None